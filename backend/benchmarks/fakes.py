@@ -0,0 +1,387 @@
+"""
+Deterministic local stand-ins for the external services used by the backend:
+the OpenAI chat and embeddings APIs, Azure Document Intelligence, clamd, the
+ClamAV REST API and the Converge API. Every fake sleeps for a configurable latency
+before answering so benchmarks can model slow upstreams.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import random
+import socket
+import struct
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EMBEDDING_DIMENSIONS = 1536
+ANSWER = (
+    "**Fact(s)**\n- The benchmark document describes the requested topic.\n\n"
+    "**Chunk(s) used to answer the question**\n- Benchmark chunk.\n\n"
+    "**Source(s)**\n- benchmark.pdf"
+)
+DOCUMENT_TEXT = (
+    "Benchmark document. This paragraph stands in for text extracted by Azure "
+    "Document Intelligence and is repeated to reach a realistic size. "
+)
+
+
+@dataclass
+class Latency:
+    """
+    Artificial latency in seconds applied by each fake service.
+    """
+
+    openai_chat: float = 0.5
+    openai_embeddings: float = 0.1
+    azure: float = 1.0
+    clamav: float = 0.05
+    converge: float = 0.5
+
+
+def fake_embedding(item: object, dimensions: int = EMBEDDING_DIMENSIONS) -> List[float]:
+    """
+    Returns a unit vector derived only from `item`, so equal inputs always embed
+    to the same vector.
+    """
+    seed = hashlib.sha256(json.dumps(item).encode()).digest()
+    rng = random.Random(seed)
+    vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector]
+
+
+def create_openai_app(latency: Latency) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        await asyncio.sleep(latency.openai_embeddings)
+
+        inputs = body["input"]
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+
+        data = []
+        for index, item in enumerate(inputs):
+            vector = fake_embedding(item, body.get("dimensions") or EMBEDDING_DIMENSIONS)
+            if body.get("encoding_format") == "base64":
+                vector = base64.b64encode(
+                    struct.pack(f"<{len(vector)}f", *vector)
+                ).decode()
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "fake-embedding"),
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+        }
+
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        await asyncio.sleep(latency.openai_chat)
+
+        model = body.get("model", "fake-chat")
+        prompt_tokens = sum(
+            len(str(message.get("content") or "")) // 4 for message in body["messages"]
+        )
+        message = {"role": "assistant", "content": ANSWER}
+
+        if body.get("functions"):
+            question = next(
+                (
+                    message["content"]
+                    for message in body["messages"]
+                    if str(message.get("content", "")).startswith("Question:")
+                ),
+                "Question: benchmark",
+            )
+            message = {
+                "role": "assistant",
+                "content": None,
+                "function_call": {
+                    "name": body["functions"][0]["name"],
+                    "arguments": json.dumps(
+                        {
+                            "question": question.removeprefix("Question: "),
+                            "answer": [
+                                {
+                                    "fact": "The benchmark document describes the topic.",
+                                    "substring_quote": ["Benchmark document."],
+                                }
+                            ],
+                        }
+                    ),
+                },
+            }
+
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(ANSWER) // 4,
+            "total_tokens": prompt_tokens + len(ANSWER) // 4,
+        }
+
+        if not body.get("stream"):
+            return {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": message,
+                        "finish_reason": "stop",
+                        "logprobs": None,
+                    }
+                ],
+                "usage": usage,
+            }
+
+        async def stream():
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+            def chunk(delta: dict, finish_reason=None) -> str:
+                payload = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": delta,
+                            "finish_reason": finish_reason,
+                            "logprobs": None,
+                        }
+                    ],
+                }
+                return f"data: {json.dumps(payload)}\n\n"
+
+            yield chunk({"role": "assistant", "content": ""})
+            for word in ANSWER.split(" "):
+                yield chunk({"content": word + " "})
+            yield chunk({}, finish_reason="stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def create_azure_app(latency: Latency) -> FastAPI:
+    app = FastAPI()
+    results: Dict[str, dict] = {}
+
+    @app.middleware("http")
+    async def collapse_slashes(request: Request, call_next):
+        # The SDK joins the endpoint and its base path with a "/", so an
+        # endpoint with a trailing slash yields "//documentintelligence"
+        request.scope["path"] = "/" + request.scope["path"].lstrip("/")
+        return await call_next(request)
+
+    @app.post("/documentintelligence/documentModels/{model_action}")
+    async def analyze(model_action: str, request: Request):
+        model_id, _, action = model_action.partition(":")
+        if action != "analyze":
+            return Response(status_code=404)
+
+        content = await request.body()
+        await asyncio.sleep(latency.azure)
+
+        result_id = str(uuid.uuid4())
+        text = DOCUMENT_TEXT * min(max(1, len(content) // len(DOCUMENT_TEXT)), 2000)
+        results[result_id] = {
+            "apiVersion": request.query_params.get("api-version"),
+            "modelId": model_id,
+            "stringIndexType": "textElements",
+            "content": text,
+            "contentFormat": request.query_params.get("outputContentFormat", "text"),
+            "pages": [
+                {
+                    "pageNumber": 1,
+                    "spans": [{"offset": 0, "length": len(text)}],
+                    "lines": [{"content": text}],
+                }
+            ],
+        }
+
+        location = (
+            f"{request.base_url}documentintelligence/documentModels/{model_id}"
+            f"/analyzeResults/{result_id}?api-version="
+            f"{request.query_params.get('api-version')}"
+        )
+        return Response(
+            status_code=202,
+            headers={"Operation-Location": location, "Retry-After": "0"},
+        )
+
+    @app.get("/documentintelligence/documentModels/{model_id}/analyzeResults/{result_id}")
+    async def analyze_result(model_id: str, result_id: str):
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        return {
+            "status": "succeeded",
+            "createdDateTime": now,
+            "lastUpdatedDateTime": now,
+            "analyzeResult": results.pop(result_id),
+        }
+
+    return app
+
+
+def create_clamav_app(latency: Latency) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/api/v1/scan")
+    async def scan(request: Request):
+        form = await request.form()
+        await asyncio.sleep(latency.clamav)
+        return {
+            "success": True,
+            "data": {
+                "result": [
+                    {"name": upload.filename, "is_infected": False, "viruses": []}
+                    for upload in form.getlist("FILES")
+                ]
+            },
+        }
+
+    return app
+
+
+def create_converge_app(latency: Latency) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/users")
+    async def users(request: Request):
+        body = await request.json()
+        await asyncio.sleep(latency.converge)
+        return {"id": str(uuid.uuid4()), "email": body["email"]}
+
+    @app.post("/conversations")
+    async def conversations(request: Request):
+        await request.json()
+        await asyncio.sleep(latency.converge)
+        return {"id": str(uuid.uuid4())}
+
+    @app.post("/messages")
+    async def messages(request: Request):
+        await request.json()
+        await asyncio.sleep(latency.converge)
+        return JSONResponse({"message": ANSWER})
+
+    return app
+
+
+class FakeServer:
+    """
+    Runs an ASGI app with uvicorn on a free local port in a background thread.
+    """
+
+    def __init__(self, app: FastAPI):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}/"
+        self._server = uvicorn.Server(
+            uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning")
+        )
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def start(self) -> "FakeServer":
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self) -> None:
+        self._server.should_exit = True
+        self._thread.join()
+
+
+class FakeClamd:
+    """
+    Speaks the subset of the clamd protocol used by the backend: IDSESSION,
+    INSTREAM, PING and END. Every stream is reported clean.
+    """
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.host = "127.0.0.1"
+        self.port = _free_port()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    def start(self) -> "FakeClamd":
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, self.host, self.port), self._loop
+        ).result()
+        return self
+
+    def stop(self) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = False
+        command_id = 0
+        try:
+            while True:
+                command = (await reader.readuntil(b"\0"))[1:-1]
+                command_id += 1
+                prefix = f"{command_id}: " if session else ""
+
+                if command == b"IDSESSION":
+                    session = True
+                    command_id = 0
+                    continue
+                if command == b"END":
+                    break
+                if command == b"PING":
+                    reply = "PONG"
+                elif command == b"INSTREAM":
+                    while True:
+                        (length,) = struct.unpack("!L", await reader.readexactly(4))
+                        if length == 0:
+                            break
+                        await reader.readexactly(length)
+                    await asyncio.sleep(self.latency.clamav)
+                    reply = "stream: OK"
+                else:
+                    reply = "UNKNOWN COMMAND"
+
+                writer.write(f"{prefix}{reply}\0".encode())
+                await writer.drain()
+                if not session:
+                    break
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+
+def start_fakes(latency: Latency) -> dict:
+    return {
+        "openai": FakeServer(create_openai_app(latency)).start(),
+        "azure": FakeServer(create_azure_app(latency)).start(),
+        "clamd": FakeClamd(latency).start(),
+        "clamav": FakeServer(create_clamav_app(latency)).start(),
+        "converge": FakeServer(create_converge_app(latency)).start(),
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
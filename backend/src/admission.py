@@ -0,0 +1,152 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, Optional
+
+from metrics import ADMISSION_QUEUE_WAIT, ADMISSION_REJECTIONS
+
+# Seconds between removals of users that are idle and have a full bucket
+USER_SWEEP_INTERVAL = 60
+
+
+class Overloaded(Exception):
+    """
+    Raised when work is not admitted. `retry_after` is the number of seconds
+    after which the caller may try again.
+    """
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"{reason}, retry after {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> Dict[str, str]:
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+@dataclass
+class _UserState:
+    semaphore: Optional[asyncio.Semaphore]
+    tokens: float
+    updated_at: float = field(default_factory=time.monotonic)
+    # Requests holding or waiting for a slot
+    active: int = 0
+
+
+class AdmissionController:
+    """
+    Limits one kind of work (chat turns, uploads, ...) per user and per worker.
+    Each user has a token bucket refilled at `rate_per_minute` with room for
+    `burst` requests, and at most `user_concurrency` requests in flight; at
+    most `global_concurrency` run in the worker as a whole. Requests wait in
+    FIFO order for up to `queue_timeout` seconds for a slot. Since a user only
+    queues for a global slot once they hold one of their own, a user with many
+    requests cannot crowd out the others. Limits set to 0 are disabled.
+    """
+
+    def __init__(
+        self,
+        operation: str,
+        global_concurrency: int,
+        user_concurrency: int,
+        rate_per_minute: float,
+        burst: int,
+        queue_timeout: float,
+    ):
+        self.operation = operation
+        self.user_concurrency = user_concurrency
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.queue_timeout = queue_timeout
+        self._global = (
+            asyncio.Semaphore(global_concurrency) if global_concurrency else None
+        )
+        self._users: Dict[str, _UserState] = {}
+        self._swept_at = time.monotonic()
+
+    @asynccontextmanager
+    async def admit(self, user_identifier: str, cost: int = 1) -> AsyncIterator[None]:
+        """
+        Holds a slot for the wrapped block, spending `cost` tokens from the
+        user's bucket. Raises Overloaded if the bucket is empty or no slot
+        frees up within the queue timeout.
+        """
+        user = self._users.get(user_identifier)
+        if user is None:
+            user = self._users[user_identifier] = _UserState(
+                semaphore=(
+                    asyncio.Semaphore(self.user_concurrency)
+                    if self.user_concurrency
+                    else None
+                ),
+                tokens=self.burst,
+            )
+
+        self._take_tokens(user, min(cost, self.burst))
+
+        user.active += 1
+        start = time.monotonic()
+        try:
+            async with self._slot(user.semaphore, start, "user_concurrency"):
+                async with self._slot(self._global, start, "global_concurrency"):
+                    ADMISSION_QUEUE_WAIT.labels(operation=self.operation).observe(
+                        time.monotonic() - start
+                    )
+                    yield
+        finally:
+            user.active -= 1
+            self._forget_idle_users()
+
+    def _take_tokens(self, user: _UserState, cost: int) -> None:
+        if not self.rate:
+            return
+
+        now = time.monotonic()
+        user.tokens = min(self.burst, user.tokens + (now - user.updated_at) * self.rate)
+        user.updated_at = now
+        if user.tokens < cost:
+            ADMISSION_REJECTIONS.labels(
+                operation=self.operation, reason="rate_limit"
+            ).inc()
+            raise Overloaded("Rate limit exceeded", (cost - user.tokens) / self.rate)
+        user.tokens -= cost
+
+    @asynccontextmanager
+    async def _slot(
+        self, semaphore: Optional[asyncio.Semaphore], start: float, reason: str
+    ) -> AsyncIterator[None]:
+        if semaphore is None:
+            yield
+            return
+
+        if semaphore.locked():
+            timeout = self.queue_timeout - (time.monotonic() - start)
+            try:
+                await asyncio.wait_for(semaphore.acquire(), max(0, timeout))
+            except asyncio.TimeoutError:
+                ADMISSION_REJECTIONS.labels(
+                    operation=self.operation, reason=reason
+                ).inc()
+                raise Overloaded("Too many requests in progress", self.queue_timeout)
+        else:
+            await semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def _forget_idle_users(self) -> None:
+        now = time.monotonic()
+        if now - self._swept_at < USER_SWEEP_INTERVAL:
+            return
+        self._swept_at = now
+
+        for user_identifier, user in list(self._users.items()):
+            refilled = not self.rate or (
+                user.tokens + (now - user.updated_at) * self.rate >= self.burst
+            )
+            if user.active == 0 and refilled:
+                del self._users[user_identifier]
@@ -1,5 +1,4 @@
 from langchain.agents import AgentExecutor, create_openai_tools_agent
-from langchain.memory.chat_memory import BaseChatMemory
 from langchain_core.prompts import (
     ChatPromptTemplate,
     SystemMessagePromptTemplate,
@@ -8,11 +7,46 @@ from langchain_core.prompts import (
 )
 from langchain_core.retrievers import BaseRetriever
 from langchain_core.tools import create_retriever_tool
-from langchain_openai import ChatOpenAI
+
+from metrics import StreamUsageChatOpenAI
+
+# Sent first and unchanged on every request, so that the provider can serve this
+# prefix of the prompt from its cache. Everything that varies per turn goes in
+# TURN_PROMPT, after the chat history.
+SYSTEM_PROMPT = """You are a productivity assistant with two capabilities:
+
+Capability 1) Searching documents/files and answering questions.
+- You can respond with answers only when a relevant question is asked,
+and only when you have access to the specific documents or files.
+- If the question is not relevant, or you do not have such access,
+you must not tell users the given format, you must not provide any answers,
+and you must only respond with your capabilities.
+- Else, make sure to be accurate and not too concise,
+use prose and bullets where appropriate,
+and format your response in the order of 3 sections with bold headers:
+1) Fact(s)
+2) Chunk(s) used to answer the question (include the page/section/FAQ headers if any)
+3) Source(s) - for this section, make sure to cite the file name
+
+Capability 2) Referencing speech writing guidelines to write speeches.
+- You must reference relevant speech writing documents/files.
+- Format your response in the order of 3 sections with bold headers:
+1) Speech - for this section, make sure to group similar points into paragraphs, and keep each paragraph as a numbered point
+2) Chunk(s) used to write the speech (include the page/section/FAQ headers if any)
+3) Source(s) - for this section, make sure to cite the file name
+
+You are to only use one capability at any one time.
+You are allowed to respond to follow up questions."""
+
+TURN_PROMPT = """{citations}
+
+{context}
+
+Provide an answer related to the given documents only for this question: {question}."""
 
 
 def create_agent(
-    memory: BaseChatMemory, retriever: BaseRetriever, llm_name: str
+    retriever: BaseRetriever, llm_name: str, verbose: bool = False
 ) -> AgentExecutor:
     retriever_tool = create_retriever_tool(
         retriever=retriever,
@@ -22,17 +56,17 @@ def create_agent(
 
     prompt = ChatPromptTemplate.from_messages(
         messages=[
-            SystemMessagePromptTemplate.from_template("You are a helpful assistant."),
+            SystemMessagePromptTemplate.from_template(SYSTEM_PROMPT),
             MessagesPlaceholder(optional=True, variable_name="chat_history"),
+            HumanMessagePromptTemplate.from_template(TURN_PROMPT),
             MessagesPlaceholder(optional=False, variable_name="agent_scratchpad"),
-            HumanMessagePromptTemplate.from_template(
-                "Provide an answer related to the given documents only for this question: {input}."
-            ),
         ]
     )
 
     agent = create_openai_tools_agent(
-        llm=ChatOpenAI(model_name=llm_name, temperature=0, streaming=True),
+        llm=StreamUsageChatOpenAI(
+            model_name=llm_name, temperature=0, streaming=True
+        ),
         tools=[retriever_tool],
         prompt=prompt,
     )
@@ -40,8 +74,7 @@ def create_agent(
     return AgentExecutor(
         agent=agent,
         tools=[retriever_tool],
-        verbose=True,
+        verbose=verbose,
         handle_parsing_errors=True,
         return_intermediate_steps=True,
-        memory=memory,
     )
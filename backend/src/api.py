@@ -1,10 +1,14 @@
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import io
 import os
 import tempfile
-from typing import Annotated, Union
+from typing import Annotated, AsyncIterator, Dict, List, Optional, Tuple, Union
 import uuid
+import zipfile
 
 import chainlit as cl
-import requests
 
 from fastapi import APIRouter, HTTPException, UploadFile, status, Depends
 from chainlit.auth import authenticate_user
@@ -12,17 +16,20 @@ from chainlit.context import init_http_context
 from chainlit.server import app
 from chainlit.logger import logger
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import (
-    AzureAIDocumentIntelligenceLoader,
-    TextLoader,
-)
-from langchain_openai import OpenAIEmbeddings
-from langchain_postgres import PGVector
-
-from database import Database
+from langchain_community.document_loaders import TextLoader
+from langchain_core.documents import Document
+from starlette.datastructures import Headers
+
+from admission import AdmissionController, Overloaded
+from database import Database, EmbeddingsModelChanged, File, FileUpload
+from embeddings import current_embeddings_model, get_embeddings
+from extraction import DOCX, PDF, PPTX, XLSX, load_documents
+from metrics import track_stage
+from scanner import ClamdError, ClamdScanner, scan_with_rest_api
 from settings import settings
 
 MAX_FILE_SIZE = 30 * 1024 * 1024  # 30MB in bytes
+SCAN_CHUNK_SIZE = 256 * 1024
 FILE_DELIMITER = "/"
 SUPPORTED_CONTENT_TYPES = [
     "application/pdf",
@@ -31,37 +38,94 @@ SUPPORTED_CONTENT_TYPES = [
     "application/vnd.openxmlformats-officedocument.presentationml.presentation",  # PPTX
     "text/plain",
 ]
+ARCHIVE_CONTENT_TYPES = ["application/zip", "application/x-zip-compressed"]
+EXTENSION_CONTENT_TYPES = {
+    ".pdf": PDF,
+    ".docx": DOCX,
+    ".xlsx": XLSX,
+    ".pptx": PPTX,
+    ".txt": "text/plain",
+}
 
 database = Database()
 router = APIRouter()
+scanner = (
+    ClamdScanner(
+        host=settings.clamd_host,
+        port=settings.clamd_port,
+        max_concurrency=settings.clamd_max_concurrency,
+        pool_size=settings.clamd_pool_size,
+        timeout=settings.clamd_timeout,
+    )
+    if settings.clamd_host
+    else None
+)
 SOURCE = "Converge"
 
+upload_admission = AdmissionController(
+    "upload",
+    global_concurrency=settings.upload_max_concurrency,
+    user_concurrency=settings.upload_max_concurrency_per_user,
+    rate_per_minute=settings.upload_rate_per_minute,
+    burst=settings.upload_burst,
+    queue_timeout=settings.admission_queue_timeout,
+)
+files_admission = AdmissionController(
+    "files",
+    global_concurrency=settings.files_max_concurrency,
+    user_concurrency=settings.files_max_concurrency_per_user,
+    rate_per_minute=settings.files_rate_per_minute,
+    burst=settings.files_burst,
+    queue_timeout=settings.admission_queue_timeout,
+)
+
+
+@asynccontextmanager
+async def admitted(
+    controller: AdmissionController, user_identifier: str, cost: int = 1
+) -> AsyncIterator[None]:
+    """
+    Runs the wrapped block once admission control lets it in, or responds with
+    429 Too Many Requests and a Retry-After header.
+    """
+    try:
+        async with controller.admit(user_identifier, cost):
+            yield
+    except Overloaded as e:
+        logger.warning(f"Rejected {controller.operation} for {user_identifier}: {e}")
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, please try again later.",
+            headers=e.retry_after_header,
+        )
+
 
 @router.get("/api/files")
 async def files(
     current_user: Annotated[Union[cl.User], Depends(authenticate_user)],
 ):
-    try:
-        init_http_context(user=current_user)
-
-        files = await database.fetch_files(current_user.identifier)
-        files_list = [
-            {
-                "id": file.id,
-                "name": file.name,
-                "size": file.size,
-                "created_at": file.created_at,
-                "updated_at": file.updated_at,
-                "source": file.source,
-            }
-            for file in files
-        ]
-
-        return files_list
-
-    except Exception as e:
-        logger.error(f"Error fetching files: {e}")
-        raise HTTPException(status_code=500, detail="Internal Server Error")
+    async with admitted(files_admission, current_user.identifier):
+        try:
+            init_http_context(user=current_user)
+
+            files = await database.fetch_files(current_user.identifier)
+            files_list = [
+                {
+                    "id": file.id,
+                    "name": file.name,
+                    "size": file.size,
+                    "created_at": file.created_at,
+                    "updated_at": file.updated_at,
+                    "source": file.source,
+                }
+                for file in files
+            ]
+
+            return files_list
+
+        except Exception as e:
+            logger.error(f"Error fetching files: {e}")
+            raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
 @router.post("/api/files", status_code=status.HTTP_201_CREATED)
@@ -81,43 +145,78 @@ async def upload(
     init_http_context(user=current_user)
     user_identifier = current_user.identifier
 
-    try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            file_path = os.path.join(temp_dir, file.filename)
-
-            with open(file_path, "wb") as buffer:
-                content = await file.read()
-                buffer.write(content)
-
-            existing_file = await database.fetch_file_by_name_and_type(
-                user_identifier=user_identifier,
-                file_name=file.filename,
-                mime_type=file.content_type,
-                source=SOURCE,
-            )
-
-            await handle_file_upload(existing_file, user_identifier, file, file_path)
-
-    except Exception as e:
-        logger.error(e)
-        raise HTTPException(status_code=422, detail="Unable to upload file.")
-
-
-async def handle_file_upload(existing_file, user_identifier, file, file_path):
-    # Scan for virus
-    if settings.clam_av_scan:
-        response = requests.post(
-            settings.clam_av_scan_url, files=[("FILES", open(file_path, "rb"))]
-        )
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=422, detail="Unable to scan file for virus."
-            )
-        response_json = response.json()
-        if response_json["success"]:
-            for data in response_json["data"]["result"]:
-                if data["is_infected"]:
-                    raise HTTPException(status_code=422, detail="File is infected.")
+    async with admitted(upload_admission, user_identifier):
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                file_path = os.path.join(temp_dir, file.filename)
+
+                with open(file_path, "wb") as buffer:
+                    content = await file.read()
+                    buffer.write(content)
+
+                existing_file = await database.fetch_file_by_name_and_type(
+                    user_identifier=user_identifier,
+                    file_name=file.filename,
+                    mime_type=file.content_type,
+                    source=SOURCE,
+                )
+
+                with track_stage("upload"):
+                    await handle_file_upload(
+                        existing_file, user_identifier, file, file_path
+                    )
+
+        except Exception as e:
+            logger.error(e)
+            raise HTTPException(status_code=422, detail="Unable to upload file.")
+
+
+async def read_chunks(file: UploadFile) -> AsyncIterator[bytes]:
+    await file.seek(0)
+    while chunk := await file.read(SCAN_CHUNK_SIZE):
+        yield chunk
+
+
+async def scan_file(file: UploadFile) -> None:
+    """
+    Scans the upload for viruses with clamd, falling back to the REST API when
+    clamd is not configured or cannot be reached.
+    """
+    with track_stage("clamav_scan"):
+        result = None
+        if scanner is not None:
+            try:
+                result = await scanner.scan(lambda: read_chunks(file))
+            except ClamdError as e:
+                logger.warning(f"Falling back to the ClamAV REST API: {e}")
+
+        if result is None:
+            try:
+                if settings.clam_av_scan_url is None:
+                    raise ClamdError("No ClamAV REST API configured")
+                await file.seek(0)
+                result = await scan_with_rest_api(
+                    settings.clam_av_scan_url.unicode_string(),
+                    file.filename,
+                    await file.read(),
+                )
+            except ClamdError as e:
+                logger.error(e)
+                raise HTTPException(
+                    status_code=422, detail="Unable to scan file for virus."
+                )
+
+    if result.infected:
+        logger.warning(f"Infected file {file.filename}: {result.signature}")
+        raise HTTPException(status_code=422, detail="File is infected.")
+
+
+async def load_upload(file: UploadFile, file_path: str) -> List[Document]:
+    """
+    Scans, parses and splits an upload. Scanning runs while the document is
+    parsed, and nothing is returned before the file is known to be clean.
+    """
+    scan = asyncio.create_task(scan_file(file)) if settings.clam_av_scan else None
 
     # Upload to S3 - no use case for now
     # s3 = boto3.client("s3")
@@ -128,49 +227,355 @@ async def handle_file_upload(existing_file, user_identifier, file, file_path):
     # )
 
     # Load documents
-    if file.content_type == "text/plain":
-        loader = TextLoader(file_path=file_path)
-    else:
-        loader = AzureAIDocumentIntelligenceLoader(
-            file_path=file_path,
-            api_key=settings.azure_doc_api_key.get_secret_value(),
-            api_endpoint=settings.azure_doc_api_endpoint.unicode_string(),
-            api_model=settings.azure_doc_api_model,
-            api_version=settings.azure_doc_api_version,
-        )
-
-    documents = loader.load_and_split(
-        RecursiveCharacterTextSplitter(chunk_size=4000, chunk_overlap=400)
+    with track_stage("document_load"):
+        try:
+            if file.content_type == "text/plain":
+                documents = TextLoader(file_path=file_path).load()
+            else:
+                documents = await load_documents(file_path, file.content_type)
+
+            documents = RecursiveCharacterTextSplitter(
+                chunk_size=4000, chunk_overlap=400
+            ).split_documents(documents)
+        except BaseException:
+            if scan is not None:
+                scan.cancel()
+            raise
+
+    if scan is not None:
+        await scan
+
+    return documents
+
+
+async def embed_upload(
+    user_identifier: str, file: UploadFile, documents: List[Document], add_chunks: bool
+) -> FileUpload:
+    # Vectors must come from the model of the user's collection
+    embeddings_model = (
+        await database.fetch_collection_embeddings_model(user_identifier)
+        or current_embeddings_model()
     )
-
-    metadatas = [{"name": file.filename} for _ in documents]
     texts = [doc.page_content for doc in documents]
 
-    pgvector = PGVector(
-        connection=database.engine,
-        embeddings=OpenAIEmbeddings(),
-        collection_name=user_identifier,
-    )
-
-    embeddings = pgvector.embedding_function.embed_documents(texts)
+    with track_stage("embedding"):
+        embeddings = await get_embeddings(embeddings_model).aembed_documents(texts)
 
     if not embeddings:
         raise ValueError("No embeddings generated")
 
-    await database.save_file_with_embeddings(
-        user_identifier=user_identifier,
+    return FileUpload(
         name=file.filename,
         size=file.size,
         mime_type=file.content_type,
-        source=SOURCE,
+        texts=texts,
         embeddings=embeddings,
-        text="\n".join(texts),
+        embeddings_model=embeddings_model,
+        add_chunks=add_chunks,
+        source=SOURCE,
+    )
+
+
+async def save_upload(
+    user_identifier: str,
+    file: UploadFile,
+    documents: List[Document],
+    upload: FileUpload,
+) -> None:
+    """
+    Stores a single upload, embedding it again if the user's collection was
+    reindexed to another model in the meantime.
+    """
+    try:
+        with track_stage("db_write"):
+            await database.save_files(user_identifier, [upload])
+    except EmbeddingsModelChanged:
+        upload = await embed_upload(
+            user_identifier, file, documents, upload.add_chunks
+        )
+        with track_stage("db_write"):
+            await database.save_files(user_identifier, [upload])
+
+
+def adds_chunks(existing_file: Optional[File]) -> bool:
+    # Re-uploads keep their chunks, and with Converge the chunks live there
+    return existing_file is None and not settings.converge_api_enabled
+
+
+async def handle_file_upload(existing_file, user_identifier, file, file_path):
+    documents = await load_upload(file, file_path)
+    upload = await embed_upload(
+        user_identifier, file, documents, adds_chunks(existing_file)
+    )
+    await save_upload(user_identifier, file, documents, upload)
+
+
+@dataclass
+class BatchItem:
+    file: UploadFile
+    file_path: Optional[str]
+    status: Dict[str, str]
+
+
+class BatchLimitExceeded(Exception):
+    """
+    Raised when a batch upload exceeds BATCH_UPLOAD_MAX_FILES or
+    BATCH_UPLOAD_MAX_SIZE.
+    """
+
+
+@dataclass
+class BatchBudget:
+    """
+    Running totals of a batch upload, checked against BATCH_UPLOAD_MAX_FILES
+    and BATCH_UPLOAD_MAX_SIZE while the files are staged, so that staging
+    stops as soon as either is exceeded.
+    """
+
+    files: int = 0
+    size: int = 0
+
+    def add_file(self) -> None:
+        self.files += 1
+        if self.files > settings.batch_upload_max_files:
+            raise BatchLimitExceeded("Too many files in batch.")
+
+    def add_bytes(self, size: int) -> None:
+        self.size += size
+        if self.size > settings.batch_upload_max_size:
+            raise BatchLimitExceeded("Batch exceeds the size limit.")
+
+
+def staged_name(file_name: Optional[str]) -> Optional[str]:
+    """
+    Returns the base name of an uploaded or archived file, or None if it has
+    none, so that staged files stay in their directory.
+    """
+    name = os.path.basename((file_name or "").replace("\\", "/"))
+    return None if name in ("", ".", "..") else name
+
+
+def extract_archive(
+    archive_path: str, directory: str, budget: BatchBudget
+) -> List[Tuple[str, Optional[str], int]]:
+    """
+    Extracts the files of a zip archive into `directory`, counting them and
+    their bytes against the batch `budget`. Returns their name, path and size;
+    the path is None for files over MAX_FILE_SIZE, which are not kept. Runs in
+    a worker thread.
+    """
+    entries = []
+    with zipfile.ZipFile(archive_path) as archive:
+        for info in archive.infolist():
+            name = staged_name(info.filename)
+            if info.is_dir() or info.filename.startswith("__MACOSX/") or not name:
+                continue
+            if name.startswith("."):
+                continue
+            budget.add_file()
+            if info.file_size > MAX_FILE_SIZE:
+                entries.append((name, None, info.file_size))
+                continue
+
+            path = os.path.join(directory, str(len(entries)), name)
+            os.makedirs(os.path.dirname(path))
+            with archive.open(info) as source, open(path, "wb") as target:
+                # Sizes in the archive directory are not trusted
+                size = 0
+                while size <= MAX_FILE_SIZE and (chunk := source.read(SCAN_CHUNK_SIZE)):
+                    budget.add_bytes(len(chunk))
+                    size += len(chunk)
+                    target.write(chunk)
+
+            if size > MAX_FILE_SIZE:
+                os.remove(path)
+                path = None
+            entries.append((name, path, size))
+    return entries
+
+
+async def stage_file(file: UploadFile, file_path: str, budget: BatchBudget) -> None:
+    os.makedirs(os.path.dirname(file_path))
+    with open(file_path, "wb") as buffer:
+        async for chunk in read_chunks(file):
+            budget.add_bytes(len(chunk))
+            buffer.write(chunk)
+
+
+async def stage_batch(files: List[UploadFile], directory: str) -> List[BatchItem]:
+    """
+    Writes the uploaded files, and the files inside uploaded zip archives, to
+    `directory`. Files that cannot be processed are marked as failed. Raises
+    BatchLimitExceeded as soon as the batch has too many files or bytes.
+    """
+    loop = asyncio.get_running_loop()
+    budget = BatchBudget()
+    items: List[BatchItem] = []
+    names = set()
+
+    def add(file: UploadFile, file_path: Optional[str]) -> None:
+        item = BatchItem(file, file_path, {"name": file.filename, "status": "pending"})
+        if file.filename is None:
+            fail(item, "Invalid file name.")
+        elif file.size > MAX_FILE_SIZE:
+            fail(item, "File size exceeds 30MB limit.")
+        elif file.content_type not in SUPPORTED_CONTENT_TYPES:
+            fail(item, "Unsupported file type.")
+        elif file.filename in names:
+            fail(item, "Duplicate file name in batch.")
+        names.add(file.filename)
+        items.append(item)
+
+    for index, file in enumerate(files):
+        file.filename = staged_name(file.filename)
+        is_archive = file.content_type in ARCHIVE_CONTENT_TYPES
+        if not is_archive:
+            budget.add_file()
+        if file.filename is None or (not is_archive and file.size > MAX_FILE_SIZE):
+            add(file, None)
+            continue
+
+        file_path = os.path.join(directory, str(index), file.filename)
+        await stage_file(file, file_path, budget)
+        if not is_archive:
+            add(file, file_path)
+            continue
+
+        entries = await loop.run_in_executor(
+            None,
+            extract_archive,
+            file_path,
+            os.path.join(directory, f"{index}.zip"),
+            budget,
+        )
+        for name, entry_path, size in entries:
+            content_type = EXTENSION_CONTENT_TYPES.get(
+                os.path.splitext(name)[1].lower(), "application/octet-stream"
+            )
+            entry = UploadFile(
+                file=open(entry_path, "rb") if entry_path else io.BytesIO(),
+                filename=name,
+                size=size,
+                headers=Headers({"content-type": content_type}),
+            )
+            add(entry, entry_path)
+
+    return items
+
+
+def fail(item: BatchItem, error: Union[str, Exception]) -> None:
+    if isinstance(error, HTTPException):
+        detail = error.detail
+    elif isinstance(error, Exception):
+        logger.error(f"Unable to upload {item.file.filename}: {error}")
+        detail = "Unable to upload file."
+    else:
+        detail = error
+    item.status.update(status="failed", detail=detail)
+
+
+async def process_batch(user_identifier: str, items: List[BatchItem]) -> None:
+    """
+    Runs the uploads of a batch through a pipeline: files are scanned and
+    parsed, then embedded, each stage with its own concurrency limit, and
+    stored in grouped transactions by a single writer. Stages overlap across
+    files, so throughput is bound by the slowest stage.
+    """
+    load_slots = asyncio.Semaphore(settings.batch_upload_load_concurrency)
+    embed_slots = asyncio.Semaphore(settings.batch_upload_embed_concurrency)
+    ready: asyncio.Queue = asyncio.Queue()
+
+    async def prepare(item: BatchItem) -> None:
+        try:
+            existing_file = await database.fetch_file_by_name_and_type(
+                user_identifier=user_identifier,
+                file_name=item.file.filename,
+                mime_type=item.file.content_type,
+                source=SOURCE,
+            )
+            async with load_slots:
+                documents = await load_upload(item.file, item.file_path)
+            async with embed_slots:
+                upload = await embed_upload(
+                    user_identifier, item.file, documents, adds_chunks(existing_file)
+                )
+        except Exception as e:
+            fail(item, e)
+            return
+
+        item.status["status"] = "created" if existing_file is None else "updated"
+        await ready.put((item, documents, upload))
+
+    async def write() -> None:
+        done = False
+        while not done:
+            group = [await ready.get()]
+            while (
+                len(group) < settings.batch_upload_write_group_size
+                and not ready.empty()
+            ):
+                group.append(ready.get_nowait())
+            if group[-1] is None:
+                group.pop()
+                done = True
+            if group:
+                await save_group(group)
+
+    async def save_group(group) -> None:
+        try:
+            with track_stage("db_write"):
+                await database.save_files(
+                    user_identifier, [upload for _, _, upload in group]
+                )
+        except Exception:
+            # Store the files one by one so that a failure only affects its file
+            for item, documents, upload in group:
+                try:
+                    await save_upload(user_identifier, item.file, documents, upload)
+                except Exception as e:
+                    fail(item, e)
+
+    writer = asyncio.create_task(write())
+    await asyncio.gather(
+        *(prepare(item) for item in items if item.status["status"] == "pending")
     )
+    await ready.put(None)
+    await writer
+
+
+@router.post("/api/files/batch", status_code=status.HTTP_200_OK)
+async def upload_batch(
+    current_user: Annotated[Union[cl.User], Depends(authenticate_user)],
+    files: List[UploadFile],
+):
+    """
+    Uploads several files, or zip archives of files, and returns the status of
+    every file.
+    """
+    init_http_context(user=current_user)
 
-    if existing_file is None and not settings.converge_api_enabled:
-        embedding_uuids = await pgvector.aadd_texts(texts, metadatas)
-        if embedding_uuids is None:
-            raise HTTPException(status_code=422, detail="No embedding created.")
+    if len(files) > settings.batch_upload_max_files:
+        raise HTTPException(status_code=422, detail="Too many files in batch.")
+
+    async with admitted(upload_admission, current_user.identifier, len(files)):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            try:
+                items = await stage_batch(files, temp_dir)
+            except BatchLimitExceeded as e:
+                raise HTTPException(status_code=422, detail=str(e))
+            except (ValueError, zipfile.BadZipFile) as e:
+                logger.error(e)
+                raise HTTPException(status_code=422, detail="Unable to read archive.")
+
+            try:
+                with track_stage("batch_upload"):
+                    await process_batch(current_user.identifier, items)
+            finally:
+                for item in items:
+                    if item.file not in files:
+                        await item.file.close()
+
+        return {"files": [item.status for item in items]}
 
 
 @router.delete("/api/files/{file_id}", status_code=status.HTTP_200_OK)
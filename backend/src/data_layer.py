@@ -0,0 +1,258 @@
+import json
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Union
+
+from chainlit.context import context
+from chainlit.data import queue_until_user_message
+from chainlit.data.sql_alchemy import SQLAlchemyDataLayer
+from chainlit.element import ElementDict
+from chainlit.step import StepDict
+from chainlit.types import (
+    FeedbackDict,
+    PageInfo,
+    PaginatedResponse,
+    Pagination,
+    ThreadDict,
+    ThreadFilter,
+)
+
+
+def isoformat(value: Union[datetime, str, None]) -> Optional[str]:
+    """
+    Formats a timestamp column the way Chainlit writes them, e.g.
+    2024-05-01T12:00:00.123456Z. Columns not yet converted by `migrate.py
+    chat-history` already hold that text.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None).isoformat() + "Z"
+
+
+class ChatHistoryDataLayer(SQLAlchemyDataLayer):
+    """
+    Chainlit's SQLAlchemy data layer with thread listing and loading done in
+    SQL. The upstream layer loads every thread of the user with all their steps
+    and elements to serve one page of the history sidebar. Here a page is read
+    with a keyset query on the (userId, createdAt, id) index and carries no
+    steps, and a thread is loaded with its latest `max_steps` steps, leaving
+    out their `generation` and `metadata` JSON, which the UI does not use.
+    """
+
+    def __init__(self, conninfo: str, max_steps: int, **kwargs):
+        super().__init__(conninfo=conninfo, **kwargs)
+        self.max_steps = max_steps
+        # Primary key of `steps`, which includes the partition key once the
+        # table is partitioned, see retention.py
+        self.step_key: List[str] = ["id"]
+
+    @queue_until_user_message()
+    async def create_step(self, step_dict: "StepDict"):
+        # Same as upstream, with the conflict target following the primary key
+        if not getattr(context.session.user, "id", None):
+            raise ValueError("No authenticated user in context")
+        step_dict["showInput"] = (
+            str(step_dict.get("showInput", "")).lower()
+            if "showInput" in step_dict
+            else None
+        )
+        parameters = {
+            key: value
+            for key, value in step_dict.items()
+            if value is not None and not (isinstance(value, dict) and not value)
+        }
+        parameters["metadata"] = json.dumps(step_dict.get("metadata", {}))
+        parameters["generation"] = json.dumps(step_dict.get("generation", {}))
+        columns = ", ".join(f'"{key}"' for key in parameters.keys())
+        values = ", ".join(f":{key}" for key in parameters.keys())
+        updates = ", ".join(
+            f'"{key}" = :{key}'
+            for key in parameters.keys()
+            if key not in self.step_key
+        )
+        conflict = ", ".join(f'"{key}"' for key in self.step_key)
+        query = f"""
+            INSERT INTO steps ({columns})
+            VALUES ({values})
+            ON CONFLICT ({conflict}) DO UPDATE
+            SET {updates};
+        """
+        await self.execute_sql(query=query, parameters=parameters)
+
+    async def list_threads(
+        self, pagination: Pagination, filters: ThreadFilter
+    ) -> PaginatedResponse:
+        if not filters.userId:
+            raise ValueError("userId is required")
+
+        conditions = ['t."userId" = :user_id']
+        parameters: Dict[str, Any] = {
+            "user_id": filters.userId,
+            "limit": pagination.first + 1,
+        }
+        if pagination.cursor:
+            conditions.append(
+                '(t."createdAt", t."id") < '
+                '(SELECT "createdAt", "id" FROM threads WHERE "id" = :cursor)'
+            )
+            parameters["cursor"] = pagination.cursor
+        if filters.search:
+            conditions.append(
+                'EXISTS (SELECT 1 FROM steps s WHERE s."threadId" = t."id" '
+                "AND s.\"output\" ILIKE :search ESCAPE '\\')"
+            )
+            parameters["search"] = "%{}%".format(
+                filters.search.replace("\\", "\\\\")
+                .replace("%", "\\%")
+                .replace("_", "\\_")
+            )
+        if filters.feedback is not None:
+            conditions.append(
+                "EXISTS (SELECT 1 FROM steps s "
+                'JOIN feedbacks f ON f."forId" = s."id" '
+                'WHERE s."threadId" = t."id" AND f."value" = :feedback)'
+            )
+            parameters["feedback"] = int(filters.feedback)
+
+        threads = await self.execute_sql(
+            query=f"""
+                SELECT t."id", t."createdAt", t."name", t."userId",
+                       t."userIdentifier", t."tags"
+                FROM threads t
+                WHERE {" AND ".join(conditions)}
+                ORDER BY t."createdAt" DESC, t."id" DESC
+                LIMIT :limit
+            """,
+            parameters=parameters,
+        )
+        threads = threads if isinstance(threads, list) else []
+
+        page = [
+            ThreadDict(
+                id=thread["id"],
+                createdAt=isoformat(thread["createdAt"]),
+                name=thread["name"],
+                userId=thread["userId"],
+                userIdentifier=thread["userIdentifier"],
+                tags=thread["tags"],
+                metadata={},
+                steps=[],
+                elements=[],
+            )
+            for thread in threads[: pagination.first]
+        ]
+        return PaginatedResponse(
+            pageInfo=PageInfo(
+                hasNextPage=len(threads) > pagination.first,
+                startCursor=page[0]["id"] if page else None,
+                endCursor=page[-1]["id"] if page else None,
+            ),
+            data=page,
+        )
+
+    async def get_thread(self, thread_id: str) -> Optional[ThreadDict]:
+        threads = await self.execute_sql(
+            query="""
+                SELECT "id", "createdAt", "name", "userId", "userIdentifier",
+                       "tags", "metadata"
+                FROM threads
+                WHERE "id" = :thread_id
+            """,
+            parameters={"thread_id": thread_id},
+        )
+        if not threads or not isinstance(threads, list):
+            return None
+        thread = threads[0]
+
+        steps = await self.execute_sql(
+            query="""
+                SELECT s.*, f."id" AS feedback_id, f."value" AS feedback_value,
+                       f."comment" AS feedback_comment
+                FROM (
+                    SELECT "id", "name", "type", "threadId", "parentId",
+                           "disableFeedback", "streaming", "waitForAnswer",
+                           "isError", "tags", "input", "output", "createdAt",
+                           "start", "end", "showInput", "language", "indent"
+                    FROM steps
+                    WHERE "threadId" = :thread_id
+                    ORDER BY "createdAt" DESC, "id" DESC
+                    LIMIT :limit
+                ) s
+                LEFT JOIN feedbacks f ON f."forId" = s."id"
+                ORDER BY s."createdAt", s."id"
+            """,
+            parameters={"thread_id": thread_id, "limit": self.max_steps},
+        )
+        elements = await self.execute_sql(
+            query="""
+                SELECT "id", "threadId", "type", "chainlitKey", "url",
+                       "objectKey", "name", "display", "size", "language",
+                       "page", "forId", "mime"
+                FROM elements
+                WHERE "threadId" = :thread_id
+            """,
+            parameters={"thread_id": thread_id},
+        )
+
+        return ThreadDict(
+            id=thread["id"],
+            createdAt=isoformat(thread["createdAt"]),
+            name=thread["name"],
+            userId=thread["userId"],
+            userIdentifier=thread["userIdentifier"],
+            tags=thread["tags"],
+            metadata=thread["metadata"] or {},
+            steps=[self._step(step) for step in steps or []],
+            elements=[self._element(element) for element in elements or []],
+        )
+
+    @staticmethod
+    def _step(row: Dict[str, Any]) -> StepDict:
+        feedback = None
+        if row["feedback_value"] is not None:
+            feedback = FeedbackDict(
+                forId=row["id"],
+                id=row["feedback_id"],
+                value=row["feedback_value"],
+                comment=row["feedback_comment"],
+            )
+        return StepDict(
+            id=row["id"],
+            name=row["name"],
+            type=row["type"],
+            threadId=row["threadId"],
+            parentId=row["parentId"],
+            disableFeedback=bool(row["disableFeedback"]),
+            streaming=bool(row["streaming"]),
+            waitForAnswer=row["waitForAnswer"],
+            isError=row["isError"],
+            metadata={},
+            tags=row["tags"],
+            input=(row["input"] or "") if row["showInput"] == "true" else None,
+            output=row["output"] or "",
+            createdAt=isoformat(row["createdAt"]),
+            start=isoformat(row["start"]),
+            end=isoformat(row["end"]),
+            generation=None,
+            showInput=row["showInput"],
+            language=row["language"],
+            indent=row["indent"],
+            feedback=feedback,
+        )
+
+    @staticmethod
+    def _element(row: Dict[str, Any]) -> ElementDict:
+        return ElementDict(
+            id=row["id"],
+            threadId=row["threadId"],
+            type=row["type"],
+            chainlitKey=row["chainlitKey"],
+            url=row["url"],
+            objectKey=row["objectKey"],
+            name=row["name"],
+            display=row["display"],
+            size=row["size"],
+            language=row["language"],
+            page=row["page"],
+            forId=row["forId"],
+            mime=row["mime"],
+        )
@@ -1,13 +1,17 @@
 import asyncio
+import json
+from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 import uuid
 from uuid_extensions import uuid7
 from sqlalchemy.sql import func
 
 import chainlit.data as cl_data
 
+from langchain_core.documents import Document
 from langchain_postgres.vectorstores import Base
+from pgvector.sqlalchemy import Vector
 from sqlalchemy import (
     BigInteger,
     DateTime,
@@ -18,16 +22,21 @@ from sqlalchemy import (
     JSON,
     ForeignKey,
     ARRAY,
+    Index,
     Integer,
     and_,
     select,
     FLOAT,
     delete,
+    bindparam,
 )
-from sqlalchemy.orm import Mapped, mapped_column, relationship, validates
-
-from chainlit.data.sql_alchemy import SQLAlchemyDataLayer
+from sqlalchemy import text as sql_text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Mapped, defer, mapped_column, relationship, validates
 
+from data_layer import ChatHistoryDataLayer
+from embeddings import document_vector, vector_index_dimensions
+from invalidation import UserCache, invalidation_bus
 from settings import settings
 
 import logging
@@ -36,6 +45,266 @@ logger = logging.getLogger(__name__)
 
 SOURCE = "Converge"
 
+# Operator class and distance operator of each quantised vector index mode
+VECTOR_INDEX_OPS = {
+    "halfvec": ("halfvec_cosine_ops", "<=>"),
+    "binary": ("bit_hamming_ops", "<~>"),
+}
+
+
+class EmbeddingsModelChanged(Exception):
+    """
+    Raised when a collection was reindexed to another embeddings model while
+    vectors for it were being computed.
+    """
+
+
+@dataclass
+class FileUpload:
+    """
+    A parsed and embedded upload, ready to be stored with `Database.save_files`.
+    """
+
+    name: str
+    size: int
+    mime_type: str
+    texts: List[str]
+    embeddings: List[List[float]]
+    embeddings_model: str
+    # Whether the chunks are added to the user's vector collection
+    add_chunks: bool
+    source: str = SOURCE
+
+
+def collection_embeddings_model(cmetadata: Optional[dict]) -> str:
+    return (cmetadata or {}).get(
+        "embeddings_model", settings.legacy_embeddings_model
+    )
+
+
+def quantised_vector(vector: str, mode: str, dimensions: int) -> str:
+    """
+    Returns the SQL expression indexed for `mode`: the first `dimensions`
+    components of `vector` as a half-precision or binary quantised vector.
+    Queries must use the same expression for Postgres to use the index.
+    """
+    prefix = f"subvector({vector}, 1, {dimensions})"
+    if mode == "halfvec":
+        return f"({prefix}::halfvec({dimensions}))"
+    return f"(binary_quantize({prefix})::bit({dimensions}))"
+
+
+# Finds the chunks of the shortlisted files, see Database.search_chunks
+FILE_ID_INDEX = "langchain_pg_embedding_file_id_idx"
+FILE_ID_INDEX_DDL = (
+    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {FILE_ID_INDEX} "
+    "ON langchain_pg_embedding (collection_id, (cmetadata->>'file_id'))"
+)
+
+
+def _scored_documents(rows) -> List[Tuple[Document, float]]:
+    return [
+        (
+            Document(id=str(row.id), page_content=row.document, metadata=row.cmetadata),
+            row.distance,
+        )
+        for row in rows
+    ]
+
+
+def vector_index_name(mode: str, dimensions: int) -> str:
+    return f"langchain_pg_embedding_{mode}_{dimensions}_idx"
+
+
+def vector_index_ddl(mode: str, dimensions: int) -> str:
+    """
+    Returns the statement building the quantised chunk index of `mode`. It is
+    built concurrently, so it must run outside a transaction, see migrate.py.
+    """
+    ops, _ = VECTOR_INDEX_OPS[mode]
+    expression = quantised_vector("embedding", mode, dimensions)
+    return (
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {vector_index_name(mode, dimensions)}"
+        f" ON langchain_pg_embedding USING hnsw ({expression} {ops})"
+    )
+
+
+def _version(version: Optional[str]) -> Tuple[int, ...]:
+    return tuple(int(part) for part in (version or "0").split(".")[:2])
+
+
+async def is_partitioned(conn, table_name: str) -> bool:
+    result = await conn.execute(
+        sql_text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:name)"),
+        {"name": table_name},
+    )
+    return bool(result.scalar())
+
+
+async def chat_history_text_columns(conn) -> Dict[str, List[str]]:
+    """
+    Returns, by table, the thread and step timestamp columns still stored as
+    ISO 8601 text, as in databases created before they were native columns.
+    """
+    result = await conn.execute(
+        sql_text(
+            "SELECT table_name, column_name FROM information_schema.columns "
+            "WHERE table_name IN ('threads', 'steps') "
+            "AND column_name IN ('createdAt', 'start', 'end') "
+            "AND data_type = 'text'"
+        )
+    )
+    text_columns: Dict[str, List[str]] = {}
+    for table_name, column_name in result:
+        text_columns.setdefault(table_name, []).append(column_name)
+    return text_columns
+
+
+STEPS_DEFAULT_PARTITION = "steps_default"
+
+
+async def create_step_partitions(
+    conn, interval: str, ahead: int, since: Optional[datetime] = None
+) -> List[str]:
+    """
+    Creates `steps` partitions, one per `interval` (day, week or month, in
+    UTC), for the time from the one holding `since` up to `ahead` intervals
+    from now that no partition covers yet, so partitions made with another
+    interval are kept and only the gaps between them are filled. Steps outside
+    every partition, e.g. once the last partition has passed because neither
+    the retention job nor a worker ran, go to a default partition; by default
+    `since` is the oldest of them, or now, and they are moved into the new
+    partitions. Returns the names of the partitions created.
+    """
+    # Workers create them concurrently at startup
+    await conn.execute(sql_text("SELECT pg_advisory_xact_lock(hashtext('steps'))"))
+    await conn.execute(
+        sql_text(
+            f"CREATE TABLE IF NOT EXISTS {STEPS_DEFAULT_PARTITION} "
+            "PARTITION OF steps DEFAULT"
+        )
+    )
+
+    wanted = await conn.execute(
+        sql_text(
+            f"""
+            SELECT lower, lower + CAST(:step AS interval) AS upper
+            FROM generate_series(
+                date_trunc(
+                    :interval,
+                    LEAST(
+                        COALESCE(
+                            CAST(:since AS timestamptz),
+                            (SELECT min("createdAt") FROM {STEPS_DEFAULT_PARTITION})
+                        ),
+                        now()
+                    ) AT TIME ZONE 'UTC'
+                ),
+                (now() + CAST(:ahead AS interval)) AT TIME ZONE 'UTC',
+                CAST(:step AS interval)
+            ) AS lower
+            """
+        ),
+        {
+            "interval": interval,
+            "step": f"1 {interval}",
+            "ahead": f"{ahead} {interval}",
+            "since": since,
+        },
+    )
+    existing = await conn.execute(
+        sql_text(
+            r"""
+            SELECT
+                CAST(substring(bound FROM 'FROM \(''([^'']+)''\)') AS timestamptz)
+                    AT TIME ZONE 'UTC' AS lower,
+                CAST(substring(bound FROM 'TO \(''([^'']+)''\)') AS timestamptz)
+                    AT TIME ZONE 'UTC' AS upper
+            FROM (
+                SELECT pg_get_expr(c.relpartbound, c.oid) AS bound
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'steps'::regclass
+            ) partitions
+            WHERE bound <> 'DEFAULT'
+            """
+        )
+    )
+    # MINVALUE and MAXVALUE bounds are not quoted and read as NULL
+    covered = [
+        (lower or datetime.min, upper or datetime.max) for lower, upper in existing
+    ]
+
+    names = []
+    for lower, upper in wanted.all():
+        for start, end in _uncovered(lower, upper, covered):
+            name = f"steps_p{start:%Y%m%d}"
+            bounds = (
+                f"FROM ('{start:%Y-%m-%d %H:%M:%S}+00') "
+                f"TO ('{end:%Y-%m-%d %H:%M:%S}+00')"
+            )
+            # A range cannot be attached while the default partition holds
+            # rows that belong to it
+            await conn.execute(
+                sql_text(f"CREATE TABLE {name} (LIKE steps INCLUDING DEFAULTS)")
+            )
+            await conn.execute(
+                sql_text(
+                    f"""
+                    WITH moved AS (
+                        DELETE FROM {STEPS_DEFAULT_PARTITION}
+                        WHERE "createdAt" >= :start AND "createdAt" < :end
+                        RETURNING *
+                    )
+                    INSERT INTO {name} SELECT * FROM moved
+                    """
+                ),
+                {
+                    "start": start.replace(tzinfo=timezone.utc),
+                    "end": end.replace(tzinfo=timezone.utc),
+                },
+            )
+            await conn.execute(
+                sql_text(
+                    f"ALTER TABLE steps ATTACH PARTITION {name} FOR VALUES {bounds}"
+                )
+            )
+            covered.append((start, end))
+            names.append(name)
+
+    orphans = (
+        await conn.execute(
+            sql_text(f"SELECT count(*) FROM {STEPS_DEFAULT_PARTITION}")
+        )
+    ).scalar()
+    if orphans:
+        logger.warning(
+            "%d steps are outside the step partitions, in %s",
+            orphans,
+            STEPS_DEFAULT_PARTITION,
+        )
+    return names
+
+
+def _uncovered(
+    lower: datetime, upper: datetime, covered: List[Tuple[datetime, datetime]]
+) -> List[Tuple[datetime, datetime]]:
+    """
+    Returns the parts of [lower, upper) that no range of `covered` overlaps.
+    """
+    gaps = []
+    for start, end in sorted(covered):
+        if end <= lower or start >= upper:
+            continue
+        if start > lower:
+            gaps.append((lower, start))
+        lower = max(lower, end)
+        if lower >= upper:
+            break
+    if lower < upper:
+        gaps.append((lower, upper))
+    return gaps
+
 
 # Our application does not need this but Chainlit needs it, so this is to satisfy Chainlit
 class OldUser(Base):
@@ -99,7 +368,15 @@ class Thread(Base):
     cmetadata: Mapped[JSON] = mapped_column(
         "metadata", JSON
     )  # metadata is a reserved key word in SQLAlchemy Declarative API, alias naming is required
-    createdAt: Mapped[Optional[str]] = mapped_column(Text)
+    createdAt: Mapped[Optional[datetime]] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+
+    __table_args__ = (
+        # History sidebar pages, see ChatHistoryDataLayer.list_threads
+        Index("threads_user_id_created_at_idx", "userId", "createdAt", "id"),
+        Index("threads_user_identifier_idx", "userIdentifier"),
+    )
 
     def __repr__(self) -> str:
         return (
@@ -133,14 +410,19 @@ class Step(Base):
     tags: Mapped[Optional[List[str]]] = mapped_column(ARRAY(Text))
     input: Mapped[Optional[str]] = mapped_column(Text)
     output: Mapped[Optional[str]] = mapped_column(Text)
-    createdAt: Mapped[Optional[str]] = mapped_column(Text)
-    start: Mapped[Optional[str]] = mapped_column(Text)
-    end: Mapped[Optional[str]] = mapped_column(Text)
+    createdAt: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+    start: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+    end: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
     generation: Mapped[Optional[JSON]] = mapped_column(JSON)
     showInput: Mapped[Optional[str]] = mapped_column(Text)
     language: Mapped[Optional[str]] = mapped_column(Text)
     indent: Mapped[Optional[int]] = mapped_column(Integer)
 
+    __table_args__ = (
+        Index("steps_thread_id_created_at_idx", "threadId", "createdAt"),
+        Index("steps_parent_id_idx", "parentId"),
+    )
+
     def __repr__(self) -> str:
         return (
             f"Step("
@@ -184,6 +466,11 @@ class Element(Base):
     forId: Mapped[Optional[str]] = mapped_column(UUID)
     mime: Mapped[Optional[str]] = mapped_column(Text)
 
+    __table_args__ = (
+        Index("elements_thread_id_idx", "threadId"),
+        Index("elements_for_id_idx", "forId"),
+    )
+
     def __repr__(self) -> str:
         return (
             f"Element("
@@ -203,6 +490,29 @@ class Element(Base):
         )
 
 
+# Chainlit manage this model
+class Feedback(Base):
+    __tablename__ = "feedbacks"
+
+    id: Mapped[UUID] = mapped_column(UUID, primary_key=True)
+    forId: Mapped[UUID] = mapped_column(UUID)
+    threadId: Mapped[Optional[UUID]] = mapped_column(UUID)
+    value: Mapped[int] = mapped_column(Integer)
+    comment: Mapped[Optional[str]] = mapped_column(Text)
+
+    __table_args__ = (Index("feedbacks_for_id_idx", "forId"),)
+
+    def __repr__(self) -> str:
+        return (
+            f"Feedback("
+            f"id={self.id!r}, "
+            f"forId={self.forId!r}, "
+            f"threadId={self.threadId!r}, "
+            f"value={self.value!r}, "
+            f"comment={self.comment!r})"
+        )
+
+
 class File(Base):
     __tablename__ = "files"
 
@@ -213,6 +523,11 @@ class File(Base):
     size: Mapped[Optional[BigInteger]] = mapped_column(BigInteger)
     mime_type: Mapped[Optional[str]] = mapped_column(Text, nullable=False)
     source: Mapped[str] = mapped_column(String(255))
+    # Document-level vector (normalised mean of the chunk embeddings), used to
+    # shortlist files before searching their chunks
+    summary_embedding: Mapped[Optional[List[float]]] = mapped_column(
+        Vector(), nullable=True
+    )
     created_at: Mapped[Optional[datetime]] = mapped_column(
         DateTime(timezone=True), server_default=func.now()
     )
@@ -295,14 +610,47 @@ class Embeddings(Base):
         )
 
 
+class ChatSession(Base):
+    __tablename__ = "chat_sessions"
+
+    thread_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True)
+    user_identifier: Mapped[str] = mapped_column(Text)
+    state: Mapped[JSON] = mapped_column(JSON)
+    created_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+    updated_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+    def __repr__(self) -> str:
+        return (
+            f"ChatSession("
+            f"threadId={self.thread_id!r}, "
+            f"userIdentifier={self.user_identifier!r}, "
+            f"createdAt={self.created_at!r}, "
+            f"updatedAt={self.updated_at!r})"
+        )
+
+
 class Database:
     def __init__(self):
-        cl_data._data_layer = SQLAlchemyDataLayer(
+        cl_data._data_layer = ChatHistoryDataLayer(
             conninfo=settings.pg_db_connection_string.get_secret_value(),
+            max_steps=settings.thread_history_max_steps,
         )
         self.engine = cl_data._data_layer.engine
         self._async_session = cl_data._data_layer.async_session
 
+        # Read on every chat turn and file listing, kept coherent across workers
+        # by the invalidation bus
+        self._files_cache = invalidation_bus.register(UserCache(settings.cache_ttl))
+        self._collection_models_cache = invalidation_bus.register(
+            UserCache(settings.cache_ttl)
+        )
+        # Set at startup from the installed pgvector version
+        self._hnsw_iterative_scan = False
+
         self.__post_init__()
 
     def __post_init__(self):
@@ -310,20 +658,326 @@ class Database:
 
     async def create_tables_if_not_exists(self):
         async with self.engine.begin() as conn:
+            await conn.execute(sql_text("CREATE EXTENSION IF NOT EXISTS vector"))
+            pgvector_version = (
+                await conn.execute(
+                    sql_text(
+                        "SELECT extversion FROM pg_extension WHERE extname = 'vector'"
+                    )
+                )
+            ).scalar()
+            self._hnsw_iterative_scan = _version(pgvector_version) >= (0, 8)
+            if settings.vector_index_mode != "full" and not self._hnsw_iterative_scan:
+                logger.warning(
+                    "pgvector %s cannot scan HNSW indexes iteratively, upgrade to "
+                    "0.8 or later: searches filtered by collection or file can "
+                    "return fewer than VECTOR_INDEX_CANDIDATES chunks",
+                    pgvector_version,
+                )
             await conn.run_sync(Base.metadata.create_all)
+            # create_all does not add columns to tables that already exist
+            await conn.execute(
+                sql_text(
+                    "ALTER TABLE files ADD COLUMN IF NOT EXISTS summary_embedding vector"
+                )
+            )
+            if await chat_history_text_columns(conn):
+                logger.warning(
+                    "Thread and step timestamps are stored as text and the chat "
+                    "history indexes are missing: run `python migrate.py "
+                    "chat-history` with the backend stopped"
+                )
+
+            # See retention.py
+            if await is_partitioned(conn, "steps"):
+                await create_step_partitions(
+                    conn,
+                    settings.steps_partition_interval,
+                    settings.steps_partitions_ahead,
+                )
+                cl_data._data_layer.step_key = ["id", "createdAt"]
+
+            if settings.vector_index_mode != "full":
+                await self._check_index(
+                    conn,
+                    vector_index_name(
+                        settings.vector_index_mode, vector_index_dimensions()
+                    ),
+                    "vector-index",
+                )
+            if settings.retrieval_file_shortlist_size:
+                await self._check_index(conn, FILE_ID_INDEX, "file-ids")
+
+    @staticmethod
+    async def _check_index(conn, index_name: str, migration: str) -> None:
+        index_exists = (
+            await conn.execute(
+                sql_text("SELECT to_regclass(:name) IS NOT NULL"),
+                {"name": index_name},
+            )
+        ).scalar()
+        if not index_exists:
+            logger.warning(
+                "Index %s does not exist, chunk searches fall back to sequential "
+                "scans until `python migrate.py %s` builds it",
+                index_name,
+                migration,
+            )
+
+    async def search_chunks(
+        self,
+        collection_name: str,
+        query_embedding: List[float],
+        k: int,
+        mode: str,
+        dimensions: int,
+        candidates: int,
+        file_ids: Optional[List[str]] = None,
+    ) -> List[Tuple[Document, float]]:
+        """
+        Searches a PGVector collection in two steps: `candidates` chunks are
+        fetched through the quantised index of `mode`, then rescored with the
+        exact cosine distance of their full-precision vectors.
+
+        The index covers every collection, so the collection filter applies to
+        the rows its scan returns. The scan visits at least `candidates` rows
+        and, with pgvector 0.8+, keeps going until enough of them match.
+
+        With `file_ids`, only the chunks of those files are ranked, by exact
+        distance, whatever the mode. They are found through the file id index
+        built by migrate.py.
+        """
+        if file_ids:
+            return await self._search_file_chunks(
+                collection_name, query_embedding, k, file_ids
+            )
+
+        _, operator = VECTOR_INDEX_OPS[mode]
+        statement = sql_text(
+            f"""
+            WITH candidates AS (
+                SELECT e.id, e.document, e.cmetadata, e.embedding
+                FROM langchain_pg_embedding e
+                JOIN langchain_pg_collection c ON c.uuid = e.collection_id
+                WHERE c.name = :collection_name
+                ORDER BY {quantised_vector("e.embedding", mode, dimensions)}
+                    {operator} {quantised_vector("CAST(:query AS vector)", mode, dimensions)}
+                LIMIT :candidates
+            )
+            SELECT id, document, cmetadata, embedding <=> CAST(:query AS vector) AS distance
+            FROM candidates
+            ORDER BY distance
+            LIMIT :k
+            """
+        ).bindparams(bindparam("query", type_=Vector()))
+        parameters = {
+            "collection_name": collection_name,
+            "query": query_embedding,
+            "candidates": max(candidates, k),
+            "k": k,
+        }
 
-    async def fetch_files(self, user_identifier: str) -> List[File]:
         async with self._async_session() as session:
-            statement = (
-                select(File)
-                .join(FileNewUser, FileNewUser.file_id == File.id)
-                .join(NewUser, FileNewUser.new_user_id == NewUser.id)
-                .where(NewUser.email == user_identifier.lower())
+            await session.execute(
+                sql_text("SELECT set_config('hnsw.ef_search', :ef_search, true)"),
+                {"ef_search": str(min(max(parameters["candidates"], 40), 1000))},
             )
-            result = await session.execute(statement)
-            files = result.scalars().all()
+            if self._hnsw_iterative_scan:
+                # Rows are rescored anyway, so the cheaper relaxed ordering is used
+                await session.execute(
+                    sql_text("SELECT set_config('hnsw.iterative_scan', :mode, true)"),
+                    {"mode": "relaxed_order"},
+                )
+            result = await session.execute(statement, parameters)
+            return _scored_documents(result)
 
-        return files
+    async def _search_file_chunks(
+        self,
+        collection_name: str,
+        query_embedding: List[float],
+        k: int,
+        file_ids: List[str],
+    ) -> List[Tuple[Document, float]]:
+        statement = sql_text(
+            """
+            SELECT e.id, e.document, e.cmetadata,
+                   e.embedding <=> CAST(:query AS vector) AS distance
+            FROM langchain_pg_embedding e
+            JOIN langchain_pg_collection c ON c.uuid = e.collection_id
+            WHERE c.name = :collection_name
+            AND (e.cmetadata->>'file_id') = ANY(:file_ids)
+            ORDER BY distance
+            LIMIT :k
+            """
+        ).bindparams(
+            bindparam("query", type_=Vector()),
+            bindparam("file_ids", type_=ARRAY(Text)),
+        )
+        async with self._async_session() as session:
+            result = await session.execute(
+                statement,
+                {
+                    "collection_name": collection_name,
+                    "query": query_embedding,
+                    "file_ids": file_ids,
+                    "k": k,
+                },
+            )
+            return _scored_documents(result)
+
+    async def fetch_files(self, user_identifier: str) -> List[File]:
+        async def load() -> List[File]:
+            async with self._async_session() as session:
+                # The cached rows leave out the summary embedding, which is
+                # only used by fetch_file_shortlist
+                statement = (
+                    select(File)
+                    .join(FileNewUser, FileNewUser.file_id == File.id)
+                    .join(NewUser, FileNewUser.new_user_id == NewUser.id)
+                    .where(NewUser.email == user_identifier.lower())
+                    .options(defer(File.summary_embedding, raiseload=True))
+                )
+                result = await session.execute(statement)
+                return result.scalars().all()
+
+        return await self._files_cache.get_or_load(user_identifier.lower(), load)
+
+    async def fetch_collection_embeddings_model(
+        self, collection_name: str
+    ) -> Optional[str]:
+        """
+        Returns the id of the embeddings model used by a PGVector collection,
+        or None if the collection does not exist yet.
+        """
+
+        async def load() -> Optional[str]:
+            async with self._async_session() as session:
+                result = await session.execute(
+                    sql_text(
+                        "SELECT cmetadata FROM langchain_pg_collection "
+                        "WHERE name = :name"
+                    ),
+                    {"name": collection_name},
+                )
+                row = result.one_or_none()
+                return (
+                    None if row is None else collection_embeddings_model(row.cmetadata)
+                )
+
+        return await self._collection_models_cache.get_or_load(
+            collection_name.lower(), load
+        )
+
+    async def _add_chunks(
+        self,
+        session,
+        collection_name: str,
+        embeddings_model: str,
+        texts: List[str],
+        embeddings: List[List[float]],
+        metadatas: List[dict],
+    ) -> List[str]:
+        """
+        Adds chunks to a PGVector collection, creating it for `embeddings_model`
+        if needed. Raises EmbeddingsModelChanged if the collection uses another
+        model, e.g. because it was reindexed after the vectors were computed.
+        """
+        await session.execute(
+            sql_text(
+                "INSERT INTO langchain_pg_collection (uuid, name, cmetadata) "
+                "VALUES (:uuid, :name, CAST(:cmetadata AS json)) "
+                "ON CONFLICT (name) DO NOTHING"
+            ),
+            {
+                "uuid": uuid.uuid4(),
+                "name": collection_name,
+                "cmetadata": json.dumps({"embeddings_model": embeddings_model}),
+            },
+        )
+        # Blocks while reindex.py swaps the collection
+        collection = (
+            await session.execute(
+                sql_text(
+                    "SELECT uuid, cmetadata FROM langchain_pg_collection "
+                    "WHERE name = :name FOR SHARE"
+                ),
+                {"name": collection_name},
+            )
+        ).one_or_none()
+
+        if collection is None or (
+            collection_embeddings_model(collection.cmetadata) != embeddings_model
+        ):
+            # The caller retries before the reindex event may have arrived
+            self._collection_models_cache.evict(collection_name.lower())
+            raise EmbeddingsModelChanged(collection_name)
+
+        return await self._insert_chunks(
+            session, collection.uuid, texts, embeddings, metadatas
+        )
+
+    async def _insert_chunks(
+        self,
+        session,
+        collection_id: uuid.UUID,
+        texts: List[str],
+        embeddings: List[List[float]],
+        metadatas: List[dict],
+    ) -> List[str]:
+        ids = [str(uuid.uuid4()) for _ in texts]
+        await session.execute(
+            sql_text(
+                "INSERT INTO langchain_pg_embedding "
+                "(id, collection_id, embedding, document, cmetadata) "
+                "VALUES (:id, :collection_id, CAST(:embedding AS vector), "
+                ":document, CAST(:cmetadata AS jsonb))"
+            ).bindparams(bindparam("embedding", type_=Vector())),
+            [
+                {
+                    "id": id,
+                    "collection_id": collection_id,
+                    "embedding": embedding,
+                    "document": text,
+                    "cmetadata": json.dumps(metadata),
+                }
+                for id, text, embedding, metadata in zip(
+                    ids, texts, embeddings, metadatas
+                )
+            ],
+        )
+        return ids
+
+    async def fetch_file_shortlist(
+        self, user_identifier: str, query_embedding: List[float], limit: int
+    ) -> List[str]:
+        """
+        Returns the ids of the user's `limit` files whose summary embedding is
+        closest to the query, plus every file of the user without a summary
+        embedding, which cannot be ranked and so is always searched. The user's
+        files are reached through the primary key of files_new_users and ranked
+        exactly, as they are few compared to the whole table. Files uploaded
+        before summary embeddings existed get one from
+        `python migrate.py file-ids`.
+        """
+        user_files = (
+            select(File.id)
+            .join(FileNewUser, FileNewUser.file_id == File.id)
+            .join(NewUser, FileNewUser.new_user_id == NewUser.id)
+            .where(NewUser.email == user_identifier.lower())
+        )
+        async with self._async_session() as session:
+            ranked = await session.execute(
+                user_files.where(File.summary_embedding.is_not(None))
+                .order_by(File.summary_embedding.cosine_distance(query_embedding))
+                .limit(limit)
+            )
+            unranked = await session.execute(
+                user_files.where(File.summary_embedding.is_(None))
+            )
+            return [
+                str(file_id)
+                for file_id in [*ranked.scalars().all(), *unranked.scalars().all()]
+            ]
 
     async def fetch_file_by_name_and_type(
         self, user_identifier: str, file_name: str, mime_type: str, source: str
@@ -344,6 +998,47 @@ class Database:
             result = await session.execute(statement)
             return result.scalars().first()
 
+    async def save_files(
+        self, user_identifier: str, uploads: List[FileUpload]
+    ) -> List[Optional[File]]:
+        """
+        Stores the files, their embeddings rows and, where requested, their
+        chunks in the user's vector collection in a single transaction.
+        """
+        async with self._async_session() as session:
+            async with session.begin():
+                files = []
+                for upload in uploads:
+                    file = await self._save_file_with_embeddings(
+                        session,
+                        user_identifier=user_identifier,
+                        name=upload.name,
+                        size=upload.size,
+                        mime_type=upload.mime_type,
+                        source=upload.source,
+                        embeddings=upload.embeddings,
+                        text="\n".join(upload.texts),
+                        summary_embedding=document_vector(upload.embeddings),
+                    )
+                    files.append(file)
+                    if upload.add_chunks:
+                        # The file id lets retrieval search the chunks of a
+                        # shortlist of files, see search_chunks
+                        metadata = {"name": upload.name}
+                        if file is not None:
+                            metadata["file_id"] = str(file.id)
+                        await self._add_chunks(
+                            session,
+                            collection_name=user_identifier,
+                            embeddings_model=upload.embeddings_model,
+                            texts=upload.texts,
+                            embeddings=upload.embeddings,
+                            metadatas=[dict(metadata) for _ in upload.texts],
+                        )
+                await invalidation_bus.publish(session, user_identifier.lower())
+        invalidation_bus.evict(user_identifier.lower())
+        return files
+
     async def save_file_with_embeddings(
         self,
         user_identifier: str,
@@ -353,51 +1048,81 @@ class Database:
         source: str,
         embeddings: List[List[float]],
         text: str,
+        summary_embedding: Optional[List[float]] = None,
     ) -> Optional[File]:
         async with self._async_session() as session:
             async with session.begin():
-                # Check if the file already exists
-                existing_file = await self.fetch_file_by_name_and_type(
+                file = await self._save_file_with_embeddings(
+                    session,
                     user_identifier=user_identifier,
-                    file_name=name,
+                    name=name,
+                    size=size,
                     mime_type=mime_type,
                     source=source,
+                    embeddings=embeddings,
+                    text=text,
+                    summary_embedding=summary_embedding,
                 )
+                await invalidation_bus.publish(session, user_identifier.lower())
+        invalidation_bus.evict(user_identifier.lower())
+        return file
 
-                if existing_file:
-                    existing_file.size = size
-                    existing_file.updated_at = func.now()
-                    session.add(existing_file)
+    async def _save_file_with_embeddings(
+        self,
+        session,
+        user_identifier: str,
+        name: str,
+        size: int,
+        mime_type: str,
+        source: str,
+        embeddings: List[List[float]],
+        text: str,
+        summary_embedding: Optional[List[float]] = None,
+    ) -> Optional[File]:
+        # Check if the file already exists
+        existing_file = await self.fetch_file_by_name_and_type(
+            user_identifier=user_identifier,
+            file_name=name,
+            mime_type=mime_type,
+            source=source,
+        )
 
-                    await self._update_embeddings(
-                        session, existing_file.id, embeddings, text
-                    )
-                    return existing_file
+        if existing_file:
+            existing_file.size = size
+            existing_file.summary_embedding = summary_embedding
+            existing_file.updated_at = func.now()
+            session.add(existing_file)
 
-                # If the file does not exist, create a new one
-                file_result = await self._create_file(
-                    session=session,
-                    user_identifier=user_identifier,
-                    name=name,
-                    size=size,
-                    mime_type=mime_type,
-                    source=source,
-                )
+            await self._update_embeddings(
+                session, existing_file.id, embeddings, text
+            )
+            return existing_file
+
+        # If the file does not exist, create a new one
+        file_result = await self._create_file(
+            session=session,
+            user_identifier=user_identifier,
+            name=name,
+            size=size,
+            mime_type=mime_type,
+            source=source,
+            summary_embedding=summary_embedding,
+        )
 
-                if file_result is None:
-                    return None
+        if file_result is None:
+            return None
 
-                success = await self._create_embeddings(
-                    session=session,
-                    file_id=file_result.id,
-                    embeddings=embeddings,
-                    text=text,
-                )
+        success = await self._create_embeddings(
+            session=session,
+            file_id=file_result.id,
+            embeddings=embeddings,
+            text=text,
+        )
 
-                if not success:
-                    return None
+        if not success:
+            return None
 
-                return file_result
+        return file_result
 
     async def _create_file(
         self,
@@ -407,6 +1132,7 @@ class Database:
         mime_type: str,
         source: str,
         user_identifier: str,
+        summary_embedding: Optional[List[float]] = None,
     ) -> Optional[File]:
         # Query to get the user ID
         result = await session.execute(
@@ -424,6 +1150,7 @@ class Database:
             size=size,
             mime_type=mime_type,
             source=source,
+            summary_embedding=summary_embedding,
         )
 
         file_new_user = FileNewUser(
@@ -499,5 +1226,35 @@ class Database:
             delete_file = delete(File).where(File.id == file_id)
             await session.execute(delete_file)
 
+            await invalidation_bus.publish(session, user_identifier.lower())
+            await session.commit()
+        invalidation_bus.evict(user_identifier.lower())
+        return True
+
+    async def fetch_chat_session(
+        self, user_identifier: str, thread_id: str
+    ) -> Optional[dict]:
+        async with self._async_session() as session:
+            statement = select(ChatSession.state).where(
+                ChatSession.thread_id == uuid.UUID(thread_id),
+                ChatSession.user_identifier == user_identifier.lower(),
+            )
+            result = await session.execute(statement)
+            return result.scalar()
+
+    async def save_chat_session(
+        self, user_identifier: str, thread_id: str, state: dict
+    ) -> None:
+        async with self._async_session() as session:
+            statement = insert(ChatSession).values(
+                thread_id=uuid.UUID(thread_id),
+                user_identifier=user_identifier.lower(),
+                state=state,
+            )
+            statement = statement.on_conflict_do_update(
+                index_elements=[ChatSession.thread_id],
+                set_={"state": statement.excluded.state, "updated_at": func.now()},
+                where=ChatSession.user_identifier == statement.excluded.user_identifier,
+            )
+            await session.execute(statement)
             await session.commit()
-            return True
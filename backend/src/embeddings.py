@@ -0,0 +1,183 @@
+import asyncio
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from settings import settings
+
+_embeddings: Dict[str, Embeddings] = {}
+
+# Output dimensions of the OpenAI models when not shortened
+OPENAI_EMBEDDINGS_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    Embeds text on the CPU with a sentence-transformers model, optionally
+    exported to ONNX. Work is split into batches that run on a thread pool,
+    which the model runtimes execute outside the GIL.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        backend: str,
+        batch_size: int,
+        workers: int,
+        dimensions: Optional[int] = None,
+    ):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                "Local embeddings require sentence-transformers. "
+                "Install them with `poetry install --extras local-embeddings`."
+            ) from e
+
+        kwargs = {} if backend == "torch" else {"backend": backend}
+        self._model = SentenceTransformer(
+            model_name, device="cpu", truncate_dim=dimensions, **kwargs
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="local-embeddings"
+        )
+        self.batch_size = batch_size
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        return self._model.encode(
+            texts,
+            batch_size=len(texts),
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+        ).tolist()
+
+    def _batches(self, texts: List[str]) -> List[List[str]]:
+        return [
+            texts[i : i + self.batch_size]
+            for i in range(0, len(texts), self.batch_size)
+        ]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        results = self._executor.map(self._encode, self._batches(texts))
+        return [vector for batch in results for vector in batch]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(self._executor, self._encode, batch)
+                for batch in self._batches(texts)
+            )
+        )
+        return [vector for batch in results for vector in batch]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        return (await loop.run_in_executor(self._executor, self._encode, [text]))[0]
+
+
+def document_vector(embeddings: List[List[float]]) -> List[float]:
+    """
+    Returns the normalised mean of a document's chunk embeddings.
+    """
+    mean = [sum(values) / len(embeddings) for values in zip(*embeddings)]
+    norm = math.sqrt(sum(value * value for value in mean)) or 1.0
+    return [value / norm for value in mean]
+
+
+def embeddings_model_id(
+    provider: str, model: str, dimensions: Optional[int] = None
+) -> str:
+    """
+    Identifies an embeddings model as "provider:model[:dimensions]". Every
+    PGVector collection records the id of the model its vectors come from.
+    """
+    model_id = f"{provider}:{model}"
+    return f"{model_id}:{dimensions}" if dimensions else model_id
+
+
+def current_embeddings_model() -> str:
+    """
+    Returns the id of the model selected by the settings, used for new
+    collections and as the target of `reindex.py`.
+    """
+    if settings.embeddings_provider == "local":
+        model = settings.local_embeddings_model
+    else:
+        model = settings.openai_embeddings_model
+    return embeddings_model_id(
+        settings.embeddings_provider, model, settings.embeddings_dimensions
+    )
+
+
+def _create_embeddings(model_id: str) -> Embeddings:
+    provider, _, model = model_id.partition(":")
+    model, _, dimensions = model.partition(":")
+
+    if provider == "local":
+        return LocalEmbeddings(
+            model_name=model,
+            backend=settings.local_embeddings_backend,
+            batch_size=settings.local_embeddings_batch_size,
+            workers=settings.local_embeddings_workers,
+            dimensions=int(dimensions) if dimensions else None,
+        )
+    if provider == "openai":
+        return OpenAIEmbeddings(
+            model=model, dimensions=int(dimensions) if dimensions else None
+        )
+    raise ValueError(f"Unknown embeddings provider in {model_id!r}")
+
+
+def get_embeddings(model_id: Optional[str] = None) -> Embeddings:
+    """
+    Returns the process-wide embeddings provider for `model_id`, by default
+    the one selected by the settings. Ingestion and retrieval on a collection
+    must use the same model, see `Database.fetch_collection_embeddings_model`.
+    """
+    model_id = model_id or current_embeddings_model()
+    if model_id not in _embeddings:
+        _embeddings[model_id] = _create_embeddings(model_id)
+    return _embeddings[model_id]
+
+
+def embeddings_dimensions(model_id: Optional[str] = None) -> int:
+    """
+    Returns the number of dimensions of the vectors of `model_id`, by default
+    the model selected by the settings.
+    """
+    model_id = model_id or current_embeddings_model()
+    provider, _, model = model_id.partition(":")
+    model, _, dimensions = model.partition(":")
+    if dimensions:
+        return int(dimensions)
+    if provider == "openai" and model in OPENAI_EMBEDDINGS_DIMENSIONS:
+        return OPENAI_EMBEDDINGS_DIMENSIONS[model]
+    return len(get_embeddings(model_id).embed_query("dimensions"))
+
+
+def vector_index_dimensions() -> int:
+    """
+    Returns the number of leading vector components covered by the quantised
+    chunk index: VECTOR_INDEX_DIMENSIONS, or all the dimensions of the current
+    embeddings model. Raises ValueError if the model has fewer, as its vectors
+    could not be indexed.
+    """
+    model_dimensions = embeddings_dimensions()
+    dimensions = settings.vector_index_dimensions or model_dimensions
+    if dimensions > model_dimensions:
+        raise ValueError(
+            f"VECTOR_INDEX_DIMENSIONS is {dimensions} but the embeddings model "
+            f"{current_embeddings_model()} has {model_dimensions} dimensions"
+        )
+    return dimensions
@@ -0,0 +1,300 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from langchain_community.document_loaders import AzureAIDocumentIntelligenceLoader
+from langchain_core.documents import Document
+
+from metrics import track_stage
+from settings import settings
+
+PDF = "application/pdf"
+DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+PPTX = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+
+# Image formats accepted by Azure Document Intelligence
+OCR_IMAGE_EXTENSIONS = {"bmp", "jpeg", "jpg", "png", "tif", "tiff"}
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+@dataclass
+class LocalExtraction:
+    # (page number, text) for every page that has a usable text layer
+    pages: List[Tuple[int, str]] = field(default_factory=list)
+    # Page numbers without a usable text layer, to be sent to OCR
+    scanned_pages: List[int] = field(default_factory=list)
+    # (page number, image path) for the images of Office pages and slides
+    # without a usable text layer, to be sent to OCR
+    scanned_images: List[Tuple[int, str]] = field(default_factory=list)
+
+
+def extract_text_layer(
+    file_path: str, mime_type: str, min_chars_per_page: int
+) -> LocalExtraction:
+    """
+    Extracts text locally from born-digital PDFs and Office files. Runs in a
+    worker process.
+    """
+    if mime_type == PDF:
+        return _extract_pdf(file_path, min_chars_per_page)
+    if mime_type == DOCX:
+        return _extract_docx(file_path, min_chars_per_page)
+    if mime_type == XLSX:
+        return _extract_xlsx(file_path)
+    if mime_type == PPTX:
+        return _extract_pptx(file_path, min_chars_per_page)
+    raise ValueError(f"Unsupported file type for local extraction: {mime_type}")
+
+
+def _extract_pdf(file_path: str, min_chars_per_page: int) -> LocalExtraction:
+    from pypdf import PdfReader
+
+    extraction = LocalExtraction()
+    for number, page in enumerate(PdfReader(file_path).pages, start=1):
+        text = (page.extract_text() or "").strip()
+        if len(text) >= min_chars_per_page:
+            extraction.pages.append((number, text))
+        else:
+            extraction.scanned_pages.append(number)
+    return extraction
+
+
+def _extract_docx(file_path: str, min_chars_per_page: int) -> LocalExtraction:
+    import docx
+    from docx.table import Table
+
+    document = docx.Document(file_path)
+    # DOCX files have no fixed pages: they are split at the page breaks Word
+    # recorded when it last laid the document out, or else at explicit ones
+    page_break = (
+        ".//w:lastRenderedPageBreak"
+        if document.element.body.xpath(".//w:lastRenderedPageBreak")
+        else './/w:br[@w:type="page"]'
+    )
+
+    pages: List[Tuple[List[str], List[str]]] = [([], [])]
+    for block in document.iter_inner_content():
+        lines, images = pages[-1]
+        if isinstance(block, Table):
+            for row in block.rows:
+                lines.append("\t".join(cell.text for cell in row.cells))
+        else:
+            lines.append(block.text)
+        images.extend(block._element.xpath(".//a:blip/@r:embed"))
+        pages.extend(([], []) for _ in block._element.xpath(page_break))
+
+    extraction = LocalExtraction()
+    for number, (lines, images) in enumerate(pages, start=1):
+        _add_office_page(
+            extraction,
+            file_path,
+            number,
+            lines,
+            [
+                (part.partname.ext, part.blob)
+                for part in map(document.part.related_parts.get, images)
+                if part is not None
+            ],
+            min_chars_per_page,
+        )
+    return _merge_pages(extraction)
+
+
+def _extract_xlsx(file_path: str) -> LocalExtraction:
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    extraction = LocalExtraction()
+    try:
+        for number, sheet in enumerate(workbook.worksheets, start=1):
+            rows = [
+                "\t".join("" if value is None else str(value) for value in row)
+                for row in sheet.iter_rows(values_only=True)
+                if any(value is not None for value in row)
+            ]
+            if rows:
+                extraction.pages.append((number, f"# {sheet.title}\n" + "\n".join(rows)))
+    finally:
+        workbook.close()
+    return extraction
+
+
+def _extract_pptx(file_path: str, min_chars_per_page: int) -> LocalExtraction:
+    import pptx
+    from pptx.shapes.group import GroupShape
+    from pptx.shapes.picture import Picture
+
+    def shapes(container):
+        for shape in container:
+            if isinstance(shape, GroupShape):
+                yield from shapes(shape.shapes)
+            else:
+                yield shape
+
+    extraction = LocalExtraction()
+    for number, slide in enumerate(pptx.Presentation(file_path).slides, start=1):
+        lines = []
+        images = []
+        for shape in shapes(slide.shapes):
+            if shape.has_text_frame:
+                lines.append(shape.text_frame.text)
+            if shape.has_table:
+                for row in shape.table.rows:
+                    lines.append("\t".join(cell.text for cell in row.cells))
+            if isinstance(shape, Picture):
+                images.append((shape.image.ext, shape.image.blob))
+        _add_office_page(
+            extraction, file_path, number, lines, images, min_chars_per_page
+        )
+    return extraction
+
+
+def _add_office_page(
+    extraction: LocalExtraction,
+    file_path: str,
+    number: int,
+    lines: List[str],
+    images: List[Tuple[str, bytes]],
+    min_chars_per_page: int,
+) -> None:
+    """
+    Adds the text of an Office page or slide. Its images are written next to
+    the file for OCR when the page has no usable text layer, e.g. a scanned
+    page pasted into a document or a slide made of screenshots.
+    """
+    text = "\n".join(line for line in lines if line.strip())
+    if text:
+        extraction.pages.append((number, text))
+    if len(text) >= min_chars_per_page:
+        return
+
+    root, _ = os.path.splitext(file_path)
+    for index, (extension, blob) in enumerate(images):
+        extension = extension.lower()
+        if extension not in OCR_IMAGE_EXTENSIONS:
+            continue
+        image_path = f"{root}.page{number}-{index}.{extension}"
+        with open(image_path, "wb") as f:
+            f.write(blob)
+        extraction.scanned_images.append((number, image_path))
+
+
+def _merge_pages(extraction: LocalExtraction) -> LocalExtraction:
+    """
+    Numbers the DOCX text as a single page unless some of its pages are sent
+    to OCR, so that documents without images keep being chunked as a whole.
+    """
+    if extraction.scanned_images or len(extraction.pages) <= 1:
+        return extraction
+    text = "\n".join(text for _, text in extraction.pages)
+    return LocalExtraction(pages=[(1, text)])
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=settings.local_extraction_workers
+        )
+    return _process_pool
+
+
+def _azure_loader(file_path: str, mode: str) -> AzureAIDocumentIntelligenceLoader:
+    return AzureAIDocumentIntelligenceLoader(
+        file_path=file_path,
+        api_key=settings.azure_doc_api_key.get_secret_value(),
+        api_endpoint=settings.azure_doc_api_endpoint.unicode_string(),
+        api_model=settings.azure_doc_api_model,
+        api_version=settings.azure_doc_api_version,
+        mode=mode,
+    )
+
+
+def _write_pdf_pages(file_path: str, page_numbers: List[int]) -> str:
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(file_path)
+    writer = PdfWriter()
+    for number in page_numbers:
+        writer.add_page(reader.pages[number - 1])
+
+    root, extension = os.path.splitext(file_path)
+    subset_path = f"{root}.scanned{extension}"
+    with open(subset_path, "wb") as f:
+        writer.write(f)
+    return subset_path
+
+
+def _ocr_images(images: List[Tuple[int, str]]) -> List[Document]:
+    documents = []
+    for number, image_path in images:
+        for document in _azure_loader(image_path, mode="markdown").load():
+            document.metadata["page"] = number
+            documents.append(document)
+    return documents
+
+
+def _ocr_pdf_pages(file_path: str, page_numbers: List[int]) -> List[Document]:
+    """
+    Sends only `page_numbers` of the PDF to Azure Document Intelligence and
+    maps the returned pages back to their original page numbers.
+    """
+    subset_path = _write_pdf_pages(file_path, page_numbers)
+    documents = _azure_loader(subset_path, mode="page").load()
+    for document in documents:
+        document.metadata["page"] = page_numbers[document.metadata["page"] - 1]
+    return documents
+
+
+async def load_documents(file_path: str, mime_type: str) -> List[Document]:
+    """
+    Loads a non plain text upload. Text layers are extracted locally in a
+    process pool and Azure Document Intelligence is only used for pages that
+    have no text layer, the images of Office pages and slides without text,
+    or Office files without any extractable text or image.
+    """
+    loop = asyncio.get_running_loop()
+
+    if not settings.local_extraction_enabled:
+        with track_stage("azure_ocr"):
+            return await loop.run_in_executor(
+                None, _azure_loader(file_path, mode="markdown").load
+            )
+
+    with track_stage("local_extraction"):
+        extraction = await loop.run_in_executor(
+            _get_process_pool(),
+            extract_text_layer,
+            file_path,
+            mime_type,
+            settings.local_extraction_min_chars_per_page,
+        )
+
+    documents = [
+        Document(page_content=text, metadata={"page": number})
+        for number, text in extraction.pages
+    ]
+
+    if extraction.scanned_pages:
+        with track_stage("azure_ocr"):
+            documents += await loop.run_in_executor(
+                None, _ocr_pdf_pages, file_path, extraction.scanned_pages
+            )
+    if extraction.scanned_images:
+        with track_stage("azure_ocr"):
+            documents += await loop.run_in_executor(
+                None, _ocr_images, extraction.scanned_images
+            )
+    if extraction.scanned_pages or extraction.scanned_images:
+        documents.sort(key=lambda document: document.metadata["page"])
+    elif not documents:
+        with track_stage("azure_ocr"):
+            documents = await loop.run_in_executor(
+                None, _azure_loader(file_path, mode="markdown").load
+            )
+
+    return documents
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from chainlit.logger import logger
+from sqlalchemy import text as sql_text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+CHANNEL = "converge_invalidation"
+
+
+class UserCache:
+    """
+    Caches one value per user, such as their file list. Entries expire after
+    `ttl` seconds and are evicted by the invalidation bus when the user's data
+    changes in any worker. The cache only serves entries while the bus is
+    listening, since changes made elsewhere would go unnoticed otherwise.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.enabled = False
+        self._entries: Dict[str, Tuple[float, Any]] = {}
+        # Bumped on every eviction, so that a value loaded before an
+        # eviction is not stored after it
+        self._versions: Dict[str, int] = {}
+        self._generation = 0
+
+    async def get_or_load(
+        self, user_identifier: str, load: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        entry = self._entries.get(user_identifier)
+        if self.enabled and entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        version = (self._generation, self._versions.get(user_identifier, 0))
+        value = await load()
+        if self.enabled and version == (
+            self._generation,
+            self._versions.get(user_identifier, 0),
+        ):
+            self._entries[user_identifier] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def evict(self, user_identifier: str) -> None:
+        self._entries.pop(user_identifier, None)
+        self._versions[user_identifier] = self._versions.get(user_identifier, 0) + 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._versions.clear()
+        self._generation += 1
+
+
+class InvalidationBus:
+    """
+    Broadcasts per-user change events between workers with Postgres
+    LISTEN/NOTIFY. Events are published inside the transaction that makes the
+    change, so they are delivered on commit, and every worker evicts the user
+    from its registered caches. The publishing worker also calls `evict` once
+    the transaction has committed, so that its own next read does not race the
+    notification.
+    """
+
+    def __init__(self, channel: str = CHANNEL, reconnect_delay: float = 5.0):
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._caches: List[UserCache] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, cache: UserCache) -> UserCache:
+        self._caches.append(cache)
+        return cache
+
+    def start(self, engine: AsyncEngine) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run(engine))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._set_enabled(False)
+
+    async def publish(self, session, user_identifier: str) -> None:
+        """
+        Queues a change event for `user_identifier` in the session's
+        transaction.
+        """
+        await session.execute(
+            sql_text("SELECT pg_notify(:channel, :payload)"),
+            {
+                "channel": self.channel,
+                "payload": json.dumps({"user": user_identifier}),
+            },
+        )
+
+    def evict(self, user_identifier: str) -> None:
+        for cache in self._caches:
+            cache.evict(user_identifier)
+
+    async def _run(self, engine: AsyncEngine) -> None:
+        while True:
+            try:
+                await self._listen(engine)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Cache invalidation listener disconnected: {e!r}")
+            # Events may have been missed while disconnected
+            self._set_enabled(False)
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _listen(self, engine: AsyncEngine) -> None:
+        # Holds one pooled connection for as long as the worker runs
+        async with engine.connect() as connection:
+            connection = await connection.execution_options(
+                isolation_level="AUTOCOMMIT"
+            )
+            await connection.exec_driver_sql(f"LISTEN {self.channel}")
+            raw_connection = await connection.get_raw_connection()
+
+            self._set_enabled(True)
+            logger.info(f"Listening for cache invalidations on {self.channel}")
+
+            async for notify in raw_connection.driver_connection.notifies():
+                self.evict(json.loads(notify.payload)["user"])
+
+    def _set_enabled(self, enabled: bool) -> None:
+        for cache in self._caches:
+            cache.clear()
+            cache.enabled = enabled
+
+
+# Shared by every Database instance in the worker; started in the server lifespan
+invalidation_bus = InvalidationBus()
@@ -0,0 +1,134 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from typing import Optional, Set
+
+from chainlit.logger import logger
+
+from metrics import EVENT_LOOP_BLOCKING_CALLS, EVENT_LOOP_LAG, EVENT_LOOP_STALLS
+
+# Audit events that mean the calling thread is about to block on I/O or sleep
+BLOCKING_AUDIT_EVENTS = {
+    "socket.connect",
+    "socket.getaddrinfo",
+    "socket.gethostbyname",
+    "socket.gethostbyaddr",
+    "subprocess.Popen",
+    "os.system",
+    "time.sleep",
+}
+
+
+class EventLoopWatchdog:
+    """
+    Measures event-loop lag continuously and reports stalls.
+
+    A task on the loop records a heartbeat every `interval` seconds and the lag
+    of each wake-up. A separate thread watches the heartbeat and, when the loop
+    has not ticked for longer than `threshold`, logs the stack of the frame that
+    is blocking it. In debug mode, blocking calls made on the loop thread are
+    flagged as well through a `sys.audit` hook.
+    """
+
+    def __init__(self, interval: float, threshold: float, debug: bool = False):
+        self.interval = interval
+        self.threshold = threshold
+        self.debug = debug
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._auditing = threading.local()
+        self._reported_call_sites: Set[str] = set()
+        self._audit_hook_installed = False
+
+    def start(self) -> None:
+        """
+        Starts the watchdog. Must be called from the event loop it should watch.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+
+        self._task = self._loop.create_task(self._measure_lag())
+        self._thread = threading.Thread(
+            target=self._watch, name="event-loop-watchdog", daemon=True
+        )
+        self._thread.start()
+
+        if self.debug:
+            self._loop.set_debug(True)
+            self._loop.slow_callback_duration = self.threshold
+            if not self._audit_hook_installed:
+                sys.addaudithook(self._audit)
+                self._audit_hook_installed = True
+
+        logger.info("Event loop watchdog started")
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+        if self._thread is not None:
+            self._thread.join()
+        self._loop_thread_id = None
+
+    async def _measure_lag(self) -> None:
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            EVENT_LOOP_LAG.observe(max(0.0, now - start - self.interval))
+
+    def _watch(self) -> None:
+        reported_heartbeat = None
+        while not self._stopped.wait(self.interval):
+            heartbeat = self._heartbeat
+            stalled_for = time.monotonic() - heartbeat - self.interval
+            if stalled_for < self.threshold or heartbeat == reported_heartbeat:
+                continue
+
+            # Report each stall once, with the stack captured while it is ongoing
+            reported_heartbeat = heartbeat
+            EVENT_LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            logger.warning(
+                "Event loop blocked for more than %.0f ms in:\n%s",
+                stalled_for * 1000,
+                stack,
+            )
+
+    def _audit(self, event: str, args: tuple) -> None:
+        if (
+            event not in BLOCKING_AUDIT_EVENTS
+            or threading.get_ident() != self._loop_thread_id
+            or getattr(self._auditing, "active", False)
+        ):
+            return
+
+        # asyncio connects non-blocking sockets on the loop thread itself
+        if event == "socket.connect" and args[0].gettimeout() == 0.0:
+            return
+
+        self._auditing.active = True
+        try:
+            stack = traceback.extract_stack()[:-1]
+            call_site = f"{event}:{stack[-1].filename}:{stack[-1].lineno}"
+            EVENT_LOOP_BLOCKING_CALLS.labels(event=event).inc()
+            if call_site not in self._reported_call_sites:
+                self._reported_call_sites.add(call_site)
+                logger.warning(
+                    "Blocking call %s on the event loop thread:\n%s",
+                    event,
+                    "".join(traceback.format_list(stack)),
+                )
+        finally:
+            self._auditing.active = False
@@ -0,0 +1,139 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from chainlit.logger import logger
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    get_buffer_string,
+)
+from langchain_core.pydantic_v1 import PrivateAttr
+
+
+class BackgroundSummaryBufferMemory(ConversationSummaryBufferMemory):
+    """
+    Keeps the most recent turns verbatim within a token budget and folds older
+    turns into a running summary. Summarisation runs as a background task so it
+    never sits on the chat critical path.
+    """
+
+    max_turns: Optional[int] = None
+
+    _pending: List[BaseMessage] = PrivateAttr(default_factory=list)
+    _summary_task: Optional[asyncio.Task] = PrivateAttr(default=None)
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        BaseChatMemory.save_context(self, inputs, outputs)
+        self._evict()
+        self._schedule_summary()
+
+    async def asave_context(
+        self, inputs: Dict[str, Any], outputs: Dict[str, str]
+    ) -> None:
+        await BaseChatMemory.asave_context(self, inputs, outputs)
+        self._evict()
+        self._schedule_summary()
+
+    def to_state(self) -> Dict[str, Any]:
+        """
+        Returns a compact, JSON serialisable snapshot of the memory. Turns that
+        were evicted but not summarised yet are kept so they are not lost.
+        """
+        return {
+            "summary": self.moving_summary_buffer,
+            "messages": _dump_messages(self.chat_memory.messages),
+            "pending": _dump_messages(self._pending),
+        }
+
+    def load_state(self, state: Dict[str, Any]) -> None:
+        """
+        Restores a snapshot produced by `to_state`.
+        """
+        self.moving_summary_buffer = state.get("summary", "")
+        self.chat_memory.messages = _load_messages(state.get("messages", []))
+        self._pending = _load_messages(state.get("pending", []))
+        self._schedule_summary()
+
+    def prune(self) -> None:
+        """
+        Evicts old turns and summarises them synchronously.
+        """
+        self._evict()
+        if self._pending:
+            pending, self._pending = self._pending, []
+            self.moving_summary_buffer = self._summarise(pending)
+
+    def clear(self) -> None:
+        super().clear()
+        self._pending = []
+
+    def _evict(self) -> None:
+        """
+        Moves the oldest human/AI pairs out of the buffer until it fits both the
+        token budget and the turn limit.
+        """
+        buffer = self.chat_memory.messages
+        while len(buffer) > 2 and (
+            self.llm.get_num_tokens_from_messages(buffer) > self.max_token_limit
+            or (self.max_turns is not None and len(buffer) > 2 * self.max_turns)
+        ):
+            self._pending.extend(buffer[:2])
+            del buffer[:2]
+
+    def _schedule_summary(self) -> None:
+        if not self._pending:
+            return
+        if self._summary_task is not None and not self._summary_task.done():
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.prune()
+            return
+
+        self._summary_task = loop.create_task(self._summarise_pending())
+
+    async def _summarise_pending(self) -> None:
+        # The batch stays in _pending until its summary is stored, so a state
+        # snapshot taken while the summary is in flight still includes it.
+        while self._pending:
+            pending = list(self._pending)
+            try:
+                summary = await self._asummarise(pending)
+            except Exception as e:
+                logger.error(f"Error summarising chat history: {e}")
+                return
+            if self._pending[: len(pending)] != pending:
+                # clear() or prune() handled the batch meanwhile
+                continue
+            self.moving_summary_buffer = summary
+            del self._pending[: len(pending)]
+
+    def _summary_prompt(self, messages: List[BaseMessage]) -> str:
+        return self.prompt.format(
+            summary=self.moving_summary_buffer,
+            new_lines=get_buffer_string(
+                messages, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix
+            ),
+        )
+
+    def _summarise(self, messages: List[BaseMessage]) -> str:
+        return self.llm.invoke(self._summary_prompt(messages)).content
+
+    async def _asummarise(self, messages: List[BaseMessage]) -> str:
+        return (await self.llm.ainvoke(self._summary_prompt(messages))).content
+
+
+def _dump_messages(messages: List[BaseMessage]) -> List[List[str]]:
+    return [[message.type, message.content] for message in messages]
+
+
+def _load_messages(data: List[List[str]]) -> List[BaseMessage]:
+    return [
+        HumanMessage(content=content) if role == "human" else AIMessage(content=content)
+        for role, content in data
+    ]
@@ -0,0 +1,249 @@
+import secrets
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from chainlit.logger import logger
+from fastapi import APIRouter, Header, HTTPException, Response
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    BaseCallbackHandler,
+)
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, LLMResult
+from langchain_openai import ChatOpenAI
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Histogram,
+    generate_latest,
+)
+
+from settings import settings
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_DURATION = Histogram(
+    "converge_stage_duration_seconds",
+    "Time spent in each stage of a chat turn or file upload.",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "converge_stage_errors_total",
+    "Number of chat or upload stages that raised an exception.",
+    ["stage"],
+)
+LLM_TOKENS = Counter(
+    "converge_llm_tokens_total",
+    "Number of LLM tokens used, by model and kind (prompt, cached_prompt, a subset "
+    "of prompt served from the provider's prompt cache, or completion).",
+    ["model", "kind"],
+)
+LLM_PROMPT_CACHE_RATIO = Histogram(
+    "converge_llm_prompt_cache_ratio",
+    "Share of the prompt tokens of each LLM call served from the prompt cache.",
+    ["model"],
+    buckets=(0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1),
+)
+LLM_COST = Counter(
+    "converge_llm_cost_usd_total",
+    "Estimated LLM cost in USD, by model.",
+    ["model"],
+)
+EVENT_LOOP_LAG = Histogram(
+    "converge_event_loop_lag_seconds",
+    "Delay between when the event loop should have woken a task and when it did.",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+EVENT_LOOP_STALLS = Counter(
+    "converge_event_loop_stalls_total",
+    "Number of times the event loop was blocked for longer than the threshold.",
+)
+EVENT_LOOP_BLOCKING_CALLS = Counter(
+    "converge_event_loop_blocking_calls_total",
+    "Blocking calls made on the event loop thread, by audit event (debug mode).",
+    ["event"],
+)
+ADMISSION_QUEUE_WAIT = Histogram(
+    "converge_admission_queue_wait_seconds",
+    "Time admitted requests waited for a concurrency slot, by operation.",
+    ["operation"],
+    buckets=STAGE_BUCKETS,
+)
+ADMISSION_REJECTIONS = Counter(
+    "converge_admission_rejections_total",
+    "Requests rejected by admission control, by operation and reason.",
+    ["operation", "reason"],
+)
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics(authorization: Optional[str] = Header(default=None)) -> Response:
+    # Served only to scrapers presenting METRICS_TOKEN, and not at all without one
+    token = settings.metrics_token
+    if token is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not secrets.compare_digest(
+        (authorization or "").encode(),
+        f"Bearer {token.get_secret_value()}".encode(),
+    ):
+        raise HTTPException(
+            status_code=401,
+            detail="Unauthorized",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """
+    Records the duration of the wrapped block as a timing span for `stage`.
+    Usable from both sync and async code.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage=stage).inc()
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_DURATION.labels(stage=stage).observe(duration)
+        logger.debug("stage=%s duration_ms=%.1f", stage, duration * 1000)
+
+
+def record_llm_usage(
+    model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0
+) -> None:
+    LLM_TOKENS.labels(model=model, kind="prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(model=model, kind="cached_prompt").inc(cached_tokens)
+    LLM_TOKENS.labels(model=model, kind="completion").inc(completion_tokens)
+    if prompt_tokens:
+        LLM_PROMPT_CACHE_RATIO.labels(model=model).observe(
+            cached_tokens / prompt_tokens
+        )
+
+    cached_cost = settings.openai_cached_input_cost_per_million
+    if cached_cost is None:
+        cached_cost = settings.openai_input_cost_per_million
+    LLM_COST.labels(model=model).inc(
+        (
+            (prompt_tokens - cached_tokens) * settings.openai_input_cost_per_million
+            + cached_tokens * cached_cost
+            + completion_tokens * settings.openai_output_cost_per_million
+        )
+        / 1_000_000
+    )
+
+
+class _UsageCapturingCompletions:
+    """
+    Chat completions client that copies the usage of a streamed response into
+    the `usage` dict passed to `create`.
+    """
+
+    def __init__(self, client: Any):
+        self._client = client
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+    async def create(self, *, usage: Optional[Dict[str, Any]] = None, **kwargs):
+        response = await self._client.create(**kwargs)
+        if usage is None:
+            return response
+        return _UsageCapturingStream(response, usage)
+
+
+class _UsageCapturingStream:
+    def __init__(self, stream: Any, usage: Dict[str, Any]):
+        self._stream = stream
+        self._usage = usage
+
+    async def __aenter__(self) -> "_UsageCapturingStream":
+        await self._stream.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self._stream.__aexit__(*exc_info)
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        async for chunk in self._stream:
+            if chunk.usage:
+                self._usage.update(chunk.usage.model_dump())
+            yield chunk
+
+
+class StreamUsageChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI that reports token usage when streaming asynchronously.
+    langchain-openai 0.1.8 neither asks for the usage of a streamed response
+    nor keeps its prompt cache details, so each stream requests the final usage
+    chunk and the raw usage is put in the `generation_info` of the chunk that
+    carries it, where UsageMetricsCallbackHandler reads it.
+    """
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.async_client = _UsageCapturingCompletions(self.async_client)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        usage: Dict[str, Any] = {}
+        kwargs.setdefault("stream_options", {"include_usage": True})
+        async for chunk in super()._astream(
+            messages, stop=stop, run_manager=run_manager, usage=usage, **kwargs
+        ):
+            if usage and getattr(chunk.message, "usage_metadata", None):
+                chunk.generation_info = {
+                    **(chunk.generation_info or {}),
+                    "token_usage": dict(usage),
+                    "model_name": self.model_name,
+                }
+                usage.clear()
+            yield chunk
+
+
+class UsageMetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Records token usage and cost for every LLM call in a LangChain run.
+    """
+
+    run_inline = True
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        llm_output = response.llm_output or {}
+        if llm_output.get("token_usage"):
+            self._record(llm_output.get("model_name"), llm_output["token_usage"])
+            return
+
+        # Streamed responses carry their usage on the generation instead, see
+        # StreamUsageChatOpenAI. The usage_metadata that langchain-openai 0.1.8
+        # sets on streamed messages has no cache details, so it is not used.
+        for generations in response.generations:
+            for generation in generations:
+                generation_info = generation.generation_info or {}
+                if generation_info.get("token_usage"):
+                    self._record(
+                        generation_info.get("model_name"),
+                        generation_info["token_usage"],
+                    )
+
+    @staticmethod
+    def _record(model: Optional[str], usage: Dict[str, Any]) -> None:
+        details = usage.get("prompt_tokens_details") or {}
+        record_llm_usage(
+            model or "unknown",
+            usage.get("prompt_tokens", 0),
+            usage.get("completion_tokens", 0),
+            details.get("cached_tokens") or 0,
+        )
@@ -0,0 +1,241 @@
+"""
+One-off schema migrations, run once per deployment instead of by every worker
+at startup.
+
+    cd backend/src
+    VECTOR_INDEX_MODE=halfvec VECTOR_INDEX_DIMENSIONS=512 python migrate.py vector-index
+
+`vector-index` builds the quantised HNSW chunk index used by VECTOR_INDEX_MODE
+over the first VECTOR_INDEX_DIMENSIONS components of the vectors.
+
+`file-ids` prepares files uploaded before retrieval shortlisted files by id
+(RETRIEVAL_FILE_SHORTLIST_SIZE): it indexes chunks by file id, records the id
+of their file on chunks that lack one, where the file name is unique for the
+user, and computes the missing file summary embeddings. It requires pgvector
+0.7 or later.
+
+Indexes are built concurrently, so uploads keep being stored while they build,
+and an index left invalid by an interrupted build is rebuilt.
+
+`chat-history` moves the thread and step timestamps of databases created before
+they were native columns from ISO 8601 text to timestamptz, and adds the chat
+history indexes. It rewrites `threads` and `steps` under an exclusive lock, so
+it is run with the backend stopped, before `retention.py partition --steps`.
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+
+from sqlalchemy import text as sql_text
+
+from database import Database, Element, Feedback, Step, Thread
+from database import FILE_ID_INDEX, FILE_ID_INDEX_DDL
+from database import chat_history_text_columns, vector_index_ddl, vector_index_name
+from database import _version
+from embeddings import vector_index_dimensions
+from settings import settings
+
+logger = logging.getLogger("migrate")
+
+
+class Migrations:
+    def __init__(self, database: Database):
+        self.database = database
+
+    async def vector_index(self) -> None:
+        mode = settings.vector_index_mode
+        if mode == "full":
+            logger.info("VECTOR_INDEX_MODE is full, no index to build")
+            return
+        dimensions = vector_index_dimensions()
+
+        async with self.database.engine.connect() as conn:
+            stored_dimensions = (
+                await conn.execute(
+                    sql_text(
+                        "SELECT min(vector_dims(embedding)) FROM langchain_pg_embedding"
+                    )
+                )
+            ).scalar()
+            if stored_dimensions is not None and stored_dimensions < dimensions:
+                sys.exit(
+                    f"Some chunks have {stored_dimensions} dimensions, fewer than "
+                    f"the {dimensions} to index: reindex them or lower "
+                    "VECTOR_INDEX_DIMENSIONS"
+                )
+
+        await self._create_index(
+            vector_index_name(mode, dimensions), vector_index_ddl(mode, dimensions)
+        )
+
+    async def file_ids(self) -> None:
+        async with self.database.engine.connect() as conn:
+            pgvector_version = (
+                await conn.execute(
+                    sql_text(
+                        "SELECT extversion FROM pg_extension WHERE extname = 'vector'"
+                    )
+                )
+            ).scalar()
+        # Summary embeddings are normalised with l2_normalize, added in 0.7
+        if _version(pgvector_version) < (0, 7):
+            sys.exit(
+                f"pgvector {pgvector_version} cannot compute summary embeddings: "
+                "upgrade it to 0.7 or later"
+            )
+
+        await self._create_index(FILE_ID_INDEX, FILE_ID_INDEX_DDL)
+
+        async with self.database._async_session() as session:
+            collections = (
+                await session.execute(
+                    sql_text(
+                        "SELECT c.uuid FROM langchain_pg_collection c "
+                        "JOIN new_users u ON u.email = lower(c.name)"
+                    )
+                )
+            ).scalars().all()
+
+        # One transaction per collection keeps the row locks short
+        tagged = 0
+        for collection_id in collections:
+            async with self.database.engine.begin() as conn:
+                result = await conn.execute(
+                    sql_text(
+                        """
+                        UPDATE langchain_pg_embedding e
+                        SET cmetadata = e.cmetadata
+                            || jsonb_build_object('file_id', f.id::text)
+                        FROM langchain_pg_collection c
+                        JOIN new_users u ON u.email = lower(c.name)
+                        JOIN files_new_users fu ON fu.new_user_id = u.id
+                        JOIN files f ON f.id = fu.file_id
+                        WHERE c.uuid = :collection_id
+                        AND e.collection_id = c.uuid
+                        AND e.cmetadata->>'file_id' IS NULL
+                        AND f.name = e.cmetadata->>'name'
+                        AND NOT EXISTS (
+                            SELECT 1 FROM files_new_users fu2
+                            JOIN files f2 ON f2.id = fu2.file_id
+                            WHERE fu2.new_user_id = u.id
+                            AND f2.name = f.name AND f2.id <> f.id
+                        )
+                        """
+                    ),
+                    {"collection_id": collection_id},
+                )
+                tagged += result.rowcount
+        logger.info("chunks: recorded the file id of %d chunks", tagged)
+
+        async with self.database.engine.begin() as conn:
+            result = await conn.execute(
+                sql_text(
+                    """
+                    UPDATE files f SET summary_embedding = s.vector
+                    FROM (
+                        SELECT file_id,
+                               l2_normalize(avg(CAST(embedding AS vector))) AS vector
+                        FROM embeddings
+                        WHERE file_id IN (
+                            SELECT id FROM files WHERE summary_embedding IS NULL
+                        )
+                        GROUP BY file_id
+                    ) s
+                    WHERE f.id = s.file_id
+                    """
+                )
+            )
+        logger.info("files: computed %d summary embeddings", result.rowcount)
+
+    async def chat_history(self) -> None:
+        async with self.database.engine.begin() as conn:
+            # A concurrent run waits here, then finds the columns converted
+            await conn.execute(
+                sql_text("SELECT pg_advisory_xact_lock(hashtext('chat_history'))")
+            )
+            text_columns = await chat_history_text_columns(conn)
+
+            # Rewrites each table once
+            for table_name, column_names in text_columns.items():
+                clauses = [
+                    f'ALTER COLUMN "{column_name}" TYPE timestamptz '
+                    f'USING NULLIF("{column_name}", \'\')::timestamptz'
+                    for column_name in column_names
+                ]
+                if table_name == "threads" and "createdAt" in column_names:
+                    clauses.append('ALTER COLUMN "createdAt" SET DEFAULT now()')
+                await conn.execute(
+                    sql_text(f"ALTER TABLE {table_name} " + ", ".join(clauses))
+                )
+                logger.info("%s: converted %s", table_name, ", ".join(column_names))
+
+            # create_all skips the indexes of tables that already exist
+            for table in [Thread, Step, Element, Feedback]:
+                for index in table.__table__.indexes:
+                    await conn.run_sync(index.create, checkfirst=True)
+        logger.info("chat history: indexes built")
+
+    async def _create_index(self, index_name: str, ddl: str) -> None:
+        # CREATE INDEX CONCURRENTLY cannot run in a transaction
+        engine = self.database.engine.execution_options(isolation_level="AUTOCOMMIT")
+        async with engine.connect() as conn:
+            valid = (
+                await conn.execute(
+                    sql_text(
+                        "SELECT indisvalid FROM pg_index "
+                        "WHERE indexrelid = to_regclass(:name)"
+                    ),
+                    {"name": index_name},
+                )
+            ).scalar()
+            if valid:
+                logger.info("%s: already built", index_name)
+                return
+            if valid is False:
+                logger.info("%s: dropping the invalid index", index_name)
+                await conn.execute(
+                    sql_text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+                )
+
+            logger.info("%s: building", index_name)
+            await conn.execute(sql_text(ddl))
+        logger.info("%s: built", index_name)
+
+
+async def run(args: argparse.Namespace, database: Database) -> None:
+    migrations = Migrations(database)
+    if args.command == "vector-index":
+        await migrations.vector_index()
+    elif args.command == "file-ids":
+        await migrations.file_ids()
+    elif args.command == "chat-history":
+        await migrations.chat_history()
+
+    await database.engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser(
+        "vector-index", help="Build the quantised chunk index of VECTOR_INDEX_MODE"
+    )
+    commands.add_parser(
+        "file-ids", help="Index chunks by file and fill in missing file ids"
+    )
+    commands.add_parser(
+        "chat-history", help="Convert text timestamps and add the history indexes"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    # Database bootstraps its tables with asyncio.run, so it is created before
+    # the migration loop starts
+    asyncio.run(run(args, Database()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+"""
+Re-embeds users' PGVector collections with the embeddings model selected by the
+settings (EMBEDDINGS_PROVIDER, OPENAI_EMBEDDINGS_MODEL, LOCAL_EMBEDDINGS_MODEL,
+EMBEDDINGS_DIMENSIONS) while the backend keeps serving:
+
+    cd backend/src
+    OPENAI_EMBEDDINGS_MODEL=text-embedding-3-small EMBEDDINGS_DIMENSIONS=512 \\
+        python reindex.py --all --concurrency 4 --max-chunks-per-minute 20000
+
+The chunks of each collection are embedded in batches into a shadow collection
+while the live one keeps answering questions with its own model. Catch-up passes
+copy chunks uploaded in the meantime. The live collection is then locked and,
+if no chunk is left to embed, replaced by the shadow in the same transaction;
+otherwise the lock is released and the remaining chunks are embedded before
+trying again. The `embeddings` rows and summary vectors of the user's files are
+rebuilt in that transaction too.
+
+Every batch is committed to the shadow collection as it completes, so an
+interrupted run resumes where it stopped when started again.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy import text as sql_text
+
+from database import Database, Embeddings, File, FileNewUser, NewUser
+from database import collection_embeddings_model
+from embeddings import current_embeddings_model, document_vector, get_embeddings
+from invalidation import invalidation_bus
+
+logger = logging.getLogger("reindex")
+
+SHADOW_SUFFIX = "#reindex"
+CUT_OVER_ATTEMPTS = 3
+
+Chunk = Tuple[str, str, dict]
+
+
+class Reindexer:
+    def __init__(
+        self,
+        database: Database,
+        batch_size: int,
+        concurrency: int,
+        max_chunks_per_minute: Optional[int],
+        catch_up_passes: int,
+    ):
+        self.database = database
+        self.embeddings_model = current_embeddings_model()
+        self.embeddings = get_embeddings(self.embeddings_model)
+        self.batch_size = batch_size
+        self.max_chunks_per_minute = max_chunks_per_minute
+        self.catch_up_passes = catch_up_passes
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._throttle_lock = asyncio.Lock()
+        self._next_batch_at = 0.0
+
+    async def collection_names(self) -> List[str]:
+        async with self.database._async_session() as session:
+            result = await session.execute(
+                sql_text(
+                    "SELECT name FROM langchain_pg_collection "
+                    "WHERE name NOT LIKE :shadow ORDER BY name"
+                ),
+                {"shadow": f"%{SHADOW_SUFFIX}"},
+            )
+            return list(result.scalars().all())
+
+    async def reindex(self, collection_name: str) -> None:
+        embeddings_model = await self.database.fetch_collection_embeddings_model(
+            collection_name
+        )
+        if embeddings_model is None:
+            logger.warning("%s: collection not found", collection_name)
+            return
+        if embeddings_model == self.embeddings_model:
+            logger.info("%s: already on %s", collection_name, embeddings_model)
+            return
+
+        shadow_id = await self._prepare_shadow(collection_name)
+
+        # Catch-up passes run until a pass has little left to copy; then the
+        # cutover is attempted, with one more pass each time uploads beat it
+        for catch_up_pass in range(self.catch_up_passes + CUT_OVER_ATTEMPTS):
+            async with self.database._async_session() as session:
+                async with session.begin():
+                    copied = await self._sync(session, collection_name, shadow_id)
+            logger.info(
+                "%s: pass %d copied %d chunks", collection_name, catch_up_pass, copied
+            )
+            if catch_up_pass < self.catch_up_passes and copied >= self.batch_size:
+                continue
+            if await self._cut_over(collection_name, shadow_id):
+                logger.info(
+                    "%s: moved from %s to %s",
+                    collection_name,
+                    embeddings_model,
+                    self.embeddings_model,
+                )
+                return
+
+        logger.warning(
+            "%s: chunks kept being uploaded during the cutover, run again to "
+            "finish it",
+            collection_name,
+        )
+
+    async def _prepare_shadow(self, collection_name: str):
+        """
+        Returns the shadow collection of `collection_name`, creating it or
+        replacing one left over by a run with another target model.
+        """
+        shadow_name = collection_name + SHADOW_SUFFIX
+        async with self.database._async_session() as session:
+            async with session.begin():
+                shadow = (
+                    await session.execute(
+                        sql_text(
+                            "SELECT uuid, cmetadata FROM langchain_pg_collection "
+                            "WHERE name = :name"
+                        ),
+                        {"name": shadow_name},
+                    )
+                ).one_or_none()
+                if shadow is not None:
+                    if (
+                        collection_embeddings_model(shadow.cmetadata)
+                        == self.embeddings_model
+                    ):
+                        return shadow.uuid
+                    await session.execute(
+                        sql_text(
+                            "DELETE FROM langchain_pg_collection WHERE uuid = :uuid"
+                        ),
+                        {"uuid": shadow.uuid},
+                    )
+
+                result = await session.execute(
+                    sql_text(
+                        "INSERT INTO langchain_pg_collection (uuid, name, cmetadata) "
+                        "VALUES (gen_random_uuid(), :name, CAST(:cmetadata AS json)) "
+                        "RETURNING uuid"
+                    ),
+                    {
+                        "name": shadow_name,
+                        "cmetadata": json.dumps(
+                            {"embeddings_model": self.embeddings_model}
+                        ),
+                    },
+                )
+                return result.scalar_one()
+
+    async def _sync(self, session, collection_name: str, shadow_id) -> int:
+        """
+        Copies the chunks of the live collection that are missing from the
+        shadow one and drops shadow chunks whose source was deleted. Returns the
+        number of chunks copied. Deletions happen in the caller's transaction,
+        copies are committed batch by batch.
+        """
+        stale, missing = await self._diff(session, collection_name, shadow_id)
+        await self._delete(session, stale)
+
+        batches = [
+            missing[i : i + self.batch_size]
+            for i in range(0, len(missing), self.batch_size)
+        ]
+        await asyncio.gather(*(self._copy(shadow_id, batch) for batch in batches))
+        return len(missing)
+
+    async def _diff(
+        self, session, collection_name: str, shadow_id
+    ) -> Tuple[List[str], List[Chunk]]:
+        """
+        Returns the ids of the shadow chunks whose source was deleted and the
+        live chunks missing from the shadow collection.
+        """
+        live = await session.execute(
+            sql_text(
+                "SELECT e.id, e.document, e.cmetadata FROM langchain_pg_embedding e "
+                "JOIN langchain_pg_collection c ON c.uuid = e.collection_id "
+                "WHERE c.name = :name"
+            ),
+            {"name": collection_name},
+        )
+        chunks: Dict[str, Chunk] = {row.id: tuple(row) for row in live}
+
+        shadow = await session.execute(
+            sql_text(
+                "SELECT id, cmetadata->>'source_id' AS source_id "
+                "FROM langchain_pg_embedding WHERE collection_id = :shadow_id"
+            ),
+            {"shadow_id": shadow_id},
+        )
+        copied = {row.source_id: row.id for row in shadow}
+
+        stale = [id for source_id, id in copied.items() if source_id not in chunks]
+        missing = [chunk for id, chunk in chunks.items() if id not in copied]
+        return stale, missing
+
+    async def _delete(self, session, ids: List[str]) -> None:
+        if ids:
+            await session.execute(
+                sql_text("DELETE FROM langchain_pg_embedding WHERE id = ANY(:ids)"),
+                {"ids": ids},
+            )
+
+    async def _copy(self, shadow_id, chunks: List[Chunk]) -> None:
+        async with self._semaphore:
+            await self._throttle(len(chunks))
+            vectors = await self.embeddings.aembed_documents(
+                [document for _, document, _ in chunks]
+            )
+            async with self.database._async_session() as session:
+                await self.database._insert_chunks(
+                    session,
+                    shadow_id,
+                    texts=[document for _, document, _ in chunks],
+                    embeddings=vectors,
+                    metadatas=[
+                        {**metadata, "source_id": id} for id, _, metadata in chunks
+                    ],
+                )
+                await session.commit()
+
+    async def _throttle(self, chunks: int) -> None:
+        if not self.max_chunks_per_minute:
+            return
+
+        loop = asyncio.get_running_loop()
+        async with self._throttle_lock:
+            start_at = max(loop.time(), self._next_batch_at)
+            self._next_batch_at = start_at + 60 * chunks / self.max_chunks_per_minute
+        await asyncio.sleep(start_at - loop.time())
+
+    async def _cut_over(self, collection_name: str, shadow_id) -> bool:
+        """
+        Replaces the live collection with the shadow one if every live chunk has
+        been copied. Returns False, changing nothing, if chunks were uploaded
+        since the last pass: they are embedded without holding the lock and the
+        cutover is retried.
+        """
+        async with self.database._async_session() as session:
+            async with session.begin():
+                # Uploads to the live collection wait on this lock, then see the
+                # new model and embed again, see Database.add_chunks
+                live_id = (
+                    await session.execute(
+                        sql_text(
+                            "SELECT uuid FROM langchain_pg_collection "
+                            "WHERE name = :name FOR UPDATE"
+                        ),
+                        {"name": collection_name},
+                    )
+                ).scalar_one()
+
+                stale, missing = await self._diff(session, collection_name, shadow_id)
+                if missing:
+                    return False
+                await self._delete(session, stale)
+
+                await session.execute(
+                    sql_text(
+                        "UPDATE langchain_pg_embedding "
+                        "SET cmetadata = cmetadata - 'source_id' "
+                        "WHERE collection_id = :shadow_id"
+                    ),
+                    {"shadow_id": shadow_id},
+                )
+                await self._rebuild_file_embeddings(
+                    session, collection_name, shadow_id
+                )
+
+                await session.execute(
+                    sql_text("DELETE FROM langchain_pg_collection WHERE uuid = :uuid"),
+                    {"uuid": live_id},
+                )
+                await session.execute(
+                    sql_text(
+                        "UPDATE langchain_pg_collection "
+                        "SET name = :name, cmetadata = CAST(:cmetadata AS json) "
+                        "WHERE uuid = :uuid"
+                    ),
+                    {
+                        "name": collection_name,
+                        "cmetadata": json.dumps(
+                            {"embeddings_model": self.embeddings_model}
+                        ),
+                        "uuid": shadow_id,
+                    },
+                )
+                await invalidation_bus.publish(session, collection_name.lower())
+        return True
+
+    async def _rebuild_file_embeddings(
+        self, session, collection_name: str, shadow_id
+    ) -> None:
+        """
+        Replaces the `embeddings` rows and summary vector of every file of the
+        user with the vectors of its chunks in the shadow collection. Files
+        without chunks there lose their summary vector.
+        """
+        from pgvector.sqlalchemy import Vector
+
+        result = await session.execute(
+            sql_text(
+                "SELECT cmetadata->>'file_id' AS file_id, cmetadata->>'name' AS name, "
+                "embedding FROM langchain_pg_embedding WHERE collection_id = :shadow_id"
+            ).columns(embedding=Vector()),
+            {"shadow_id": shadow_id},
+        )
+        # Chunks stored before they recorded their file id are matched by name
+        vectors: Dict[str, List[List[float]]] = {}
+        for row in result:
+            vectors.setdefault(row.file_id or row.name, []).append(
+                row.embedding.tolist()
+            )
+
+        files = await session.execute(
+            select(File)
+            .join(FileNewUser, FileNewUser.file_id == File.id)
+            .join(NewUser, FileNewUser.new_user_id == NewUser.id)
+            .where(NewUser.email == collection_name.lower())
+        )
+        for file in files.scalars().all():
+            file_vectors = vectors.get(str(file.id)) or vectors.get(file.name)
+            if not file_vectors:
+                # A vector from the old model cannot be ranked against queries
+                # embedded with the new one
+                file.summary_embedding = None
+                continue
+
+            # Every row of a file holds the full text of the file
+            text = (
+                await session.execute(
+                    select(Embeddings.text)
+                    .where(Embeddings.file_id == file.id)
+                    .limit(1)
+                )
+            ).scalar_one_or_none()
+            await self.database._update_embeddings(
+                session, file.id, file_vectors, text or ""
+            )
+            file.summary_embedding = document_vector(file_vectors)
+
+
+async def run(args: argparse.Namespace, database: Database) -> None:
+    reindexer = Reindexer(
+        database,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        max_chunks_per_minute=args.max_chunks_per_minute,
+        catch_up_passes=args.catch_up_passes,
+    )
+    collection_names = args.users or await reindexer.collection_names()
+    logger.info(
+        "Reindexing %d collections with %s",
+        len(collection_names),
+        reindexer.embeddings_model,
+    )
+
+    for collection_name in collection_names:
+        await reindexer.reindex(collection_name)
+
+    await database.engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    users = parser.add_mutually_exclusive_group(required=True)
+    users.add_argument("--users", nargs="+", help="User emails to reindex")
+    users.add_argument("--all", action="store_true", help="Reindex every user")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Embedding requests in flight"
+    )
+    parser.add_argument("--max-chunks-per-minute", type=int)
+    parser.add_argument("--catch-up-passes", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    # Database bootstraps its tables with asyncio.run, so it is created before
+    # the reindex loop starts
+    asyncio.run(run(args, Database()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import tiktoken
+from langchain_core.documents import Document
+
+
+class CrossEncoderReranker:
+    """
+    Reranks retrieved chunks with a local CPU cross-encoder. Chunks scoring
+    below `score_threshold` are dropped and the rest are kept, best first,
+    until `token_budget` is spent, so the number of chunks sent to the LLM
+    adapts to how many are actually relevant.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        score_threshold: float,
+        token_budget: int,
+        workers: int = 1,
+    ):
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as e:
+            raise ImportError(
+                "Reranking requires sentence-transformers. "
+                "Install them with `poetry install --extras local-embeddings`."
+            ) from e
+
+        self._model = CrossEncoder(model_name, device="cpu")
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="reranker"
+        )
+        self._encoding = tiktoken.get_encoding("cl100k_base")
+        self.score_threshold = score_threshold
+        self.token_budget = token_budget
+
+    def _score(self, query: str, documents: List[Document]) -> List[float]:
+        return self._model.predict(
+            [(query, document.page_content) for document in documents],
+            convert_to_numpy=True,
+        ).tolist()
+
+    def _select(
+        self, documents: List[Document], scores: List[float]
+    ) -> List[Document]:
+        selected = []
+        tokens = 0
+        for document, score in sorted(
+            zip(documents, scores), key=lambda pair: pair[1], reverse=True
+        ):
+            if score < self.score_threshold:
+                break
+            tokens += len(self._encoding.encode(document.page_content))
+            if tokens > self.token_budget and selected:
+                break
+            document.metadata["rerank_score"] = score
+            selected.append(document)
+        return selected
+
+    def rerank(self, query: str, documents: List[Document]) -> List[Document]:
+        if not documents:
+            return []
+        return self._select(documents, self._score(query, documents))
+
+    async def arerank(self, query: str, documents: List[Document]) -> List[Document]:
+        if not documents:
+            return []
+        loop = asyncio.get_running_loop()
+        scores = await loop.run_in_executor(
+            self._executor, self._score, query, documents
+        )
+        return self._select(documents, scores)
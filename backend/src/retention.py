@@ -0,0 +1,347 @@
+"""
+Keeps the chat history and embeddings tables bounded.
+
+Run it periodically, e.g. daily from cron:
+
+    cd backend/src
+    STEPS_RETENTION_DAYS=180 STEPS_COMPACT_AFTER_DAYS=14 python retention.py run
+
+`run` creates the upcoming `steps` partitions, deletes steps older than
+STEPS_RETENTION_DAYS, along with the threads left without steps, and compacts
+the intermediate steps (tool, LLM and chain runs) older than
+STEPS_COMPACT_AFTER_DAYS: their input and output are trimmed to
+STEPS_COMPACT_MAX_CHARS and their generation is dropped. User and assistant
+messages are kept whole.
+
+Partitioning is optional and converts the existing tables once, copying their
+rows under an exclusive lock, so it is run with the backend stopped:
+
+    python retention.py partition --steps --embeddings
+
+`steps` is then partitioned by creation time, one partition per
+STEPS_PARTITION_INTERVAL, and retention drops whole partitions instead of
+deleting rows. Partitions are created STEPS_PARTITIONS_AHEAD intervals ahead by
+`run` and at every worker start; steps written past the last one, should both
+lapse, go to the `steps_default` partition and are moved out by the next `run`.
+Changing STEPS_PARTITION_INTERVAL keeps the existing partitions and only fills
+the time after them. `embeddings` is hash partitioned by file into
+EMBEDDINGS_PARTITIONS partitions, so that vacuum and index maintenance work
+on one small table at a time.
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+from typing import List
+
+from sqlalchemy import text as sql_text
+
+from database import Database, Element, Feedback, Step
+from database import chat_history_text_columns, create_step_partitions
+from database import is_partitioned
+from settings import settings
+
+logger = logging.getLogger("retention")
+
+# Step types of chat messages, which are never compacted
+MESSAGE_STEP_TYPES = ["user_message", "assistant_message"]
+TRIMMED_MARKER = "\n[trimmed]"
+
+
+class Retention:
+    def __init__(self, database: Database, batch_size: int):
+        self.database = database
+        self.batch_size = batch_size
+
+    async def partition_steps(self) -> None:
+        async with self.database.engine.begin() as conn:
+            if await is_partitioned(conn, "steps"):
+                logger.info("steps: already partitioned")
+                return
+            if await chat_history_text_columns(conn):
+                sys.exit("steps: run `python migrate.py chat-history` first")
+
+            await conn.execute(sql_text("LOCK TABLE steps IN ACCESS EXCLUSIVE MODE"))
+            # Range partitions cannot hold rows without a partition key
+            await conn.execute(
+                sql_text(
+                    'UPDATE steps SET "createdAt" = COALESCE("start", now()) '
+                    'WHERE "createdAt" IS NULL'
+                )
+            )
+            since = (
+                await conn.execute(sql_text('SELECT min("createdAt") FROM steps'))
+            ).scalar()
+
+            await conn.execute(sql_text("ALTER TABLE steps RENAME TO steps_old"))
+            await conn.execute(
+                sql_text(
+                    "CREATE TABLE steps (LIKE steps_old INCLUDING DEFAULTS) "
+                    'PARTITION BY RANGE ("createdAt")'
+                )
+            )
+            await conn.execute(
+                sql_text(
+                    'ALTER TABLE steps ALTER COLUMN "createdAt" SET DEFAULT now(), '
+                    'ALTER COLUMN "createdAt" SET NOT NULL'
+                )
+            )
+            partitions = await create_step_partitions(
+                conn,
+                settings.steps_partition_interval,
+                settings.steps_partitions_ahead,
+                since=since,
+            )
+            copied = await conn.execute(
+                sql_text("INSERT INTO steps SELECT * FROM steps_old")
+            )
+            await conn.execute(sql_text("DROP TABLE steps_old"))
+
+            await conn.execute(
+                sql_text('ALTER TABLE steps ADD PRIMARY KEY ("id", "createdAt")')
+            )
+            for index in Step.__table__.indexes:
+                await conn.run_sync(index.create)
+
+        logger.info(
+            "steps: copied %d rows into %d partitions", copied.rowcount, len(partitions)
+        )
+
+    async def partition_embeddings(self) -> None:
+        partitions = settings.embeddings_partitions
+        async with self.database.engine.begin() as conn:
+            if await is_partitioned(conn, "embeddings"):
+                logger.info("embeddings: already partitioned")
+                return
+
+            await conn.execute(
+                sql_text("LOCK TABLE embeddings IN ACCESS EXCLUSIVE MODE")
+            )
+            await conn.execute(
+                sql_text("ALTER TABLE embeddings RENAME TO embeddings_old")
+            )
+            await conn.execute(
+                sql_text(
+                    "CREATE TABLE embeddings "
+                    "(LIKE embeddings_old INCLUDING DEFAULTS) "
+                    "PARTITION BY HASH (file_id)"
+                )
+            )
+            for remainder in range(partitions):
+                await conn.execute(
+                    sql_text(
+                        f"CREATE TABLE embeddings_p{remainder} PARTITION OF embeddings "
+                        f"FOR VALUES WITH (MODULUS {partitions}, "
+                        f"REMAINDER {remainder})"
+                    )
+                )
+            copied = await conn.execute(
+                sql_text("INSERT INTO embeddings SELECT * FROM embeddings_old")
+            )
+            await conn.execute(sql_text("DROP TABLE embeddings_old"))
+
+            await conn.execute(
+                sql_text("ALTER TABLE embeddings ADD PRIMARY KEY (id, file_id)")
+            )
+            await conn.execute(
+                sql_text(
+                    "ALTER TABLE embeddings ADD CONSTRAINT embeddings_file_id_fkey "
+                    "FOREIGN KEY (file_id) REFERENCES files (id)"
+                )
+            )
+            await conn.execute(
+                sql_text("CREATE INDEX embeddings_file_id_idx ON embeddings (file_id)")
+            )
+
+        logger.info(
+            "embeddings: copied %d rows into %d partitions", copied.rowcount, partitions
+        )
+
+    async def run(self) -> None:
+        async with self.database.engine.begin() as conn:
+            if await is_partitioned(conn, "steps"):
+                partitions = await create_step_partitions(
+                    conn,
+                    settings.steps_partition_interval,
+                    settings.steps_partitions_ahead,
+                )
+                logger.info("steps: created partitions %s", partitions or "none")
+
+        if settings.steps_retention_days:
+            await self.expire_steps(settings.steps_retention_days)
+        if settings.steps_compact_after_days:
+            await self.compact_steps(
+                settings.steps_compact_after_days, settings.steps_compact_max_chars
+            )
+
+    async def expire_steps(self, days: int) -> None:
+        """
+        Removes the steps created more than `days` days ago, then the threads
+        of that age that have no steps left, with their elements and feedback.
+        """
+        async with self.database.engine.begin() as conn:
+            partitioned = await is_partitioned(conn, "steps")
+            if partitioned:
+                dropped = await self._drop_step_partitions(conn, days)
+                logger.info("steps: dropped partitions %s", dropped or "none")
+        if not partitioned:
+            await self._delete_steps(days)
+
+        async with self.database.engine.begin() as conn:
+            threads = (
+                await conn.execute(
+                    sql_text(
+                        """
+                        SELECT t."id" FROM threads t
+                        WHERE t."createdAt" < now() - make_interval(days => :days)
+                        AND NOT EXISTS (
+                            SELECT 1 FROM steps s WHERE s."threadId" = t."id"
+                        )
+                        """
+                    ),
+                    {"days": days},
+                )
+            ).scalars().all()
+            for table in [Feedback.__table__, Element.__table__]:
+                await conn.execute(
+                    table.delete().where(table.c.threadId.in_(threads))
+                )
+            await conn.execute(
+                sql_text("DELETE FROM chat_sessions WHERE thread_id = ANY(:ids)"),
+                {"ids": threads},
+            )
+            await conn.execute(
+                sql_text('DELETE FROM threads WHERE "id" = ANY(:ids)'),
+                {"ids": threads},
+            )
+        logger.info("threads: deleted %d without steps", len(threads))
+
+    async def _delete_steps(self, days: int) -> None:
+        deleted = 0
+        while True:
+            async with self.database.engine.begin() as conn:
+                result = await conn.execute(
+                    sql_text(
+                        """
+                        DELETE FROM steps WHERE "id" IN (
+                            SELECT "id" FROM steps
+                            WHERE "createdAt" < now() - make_interval(days => :days)
+                            LIMIT :limit
+                        )
+                        """
+                    ),
+                    {"days": days, "limit": self.batch_size},
+                )
+            deleted += result.rowcount
+            if result.rowcount < self.batch_size:
+                break
+        logger.info("steps: deleted %d rows", deleted)
+
+    async def _drop_step_partitions(self, conn, days: int) -> List[str]:
+        # Partitions whose upper bound has passed the retention cutoff
+        result = await conn.execute(
+            sql_text(
+                r"""
+                SELECT c.relname
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'steps'::regclass
+                AND CAST(
+                    substring(
+                        pg_get_expr(c.relpartbound, c.oid)
+                        FROM 'TO \(''([^'']+)''\)'
+                    ) AS timestamptz
+                ) <= now() - make_interval(days => :days)
+                ORDER BY c.relname
+                """
+            ),
+            {"days": days},
+        )
+        names = list(result.scalars().all())
+        for name in names:
+            await conn.execute(sql_text(f"DROP TABLE {name}"))
+        return names
+
+    async def compact_steps(self, days: int, max_chars: int) -> None:
+        """
+        Trims the input and output of intermediate steps created more than
+        `days` days ago to `max_chars` characters and drops their generation.
+        """
+        keep = max_chars - len(TRIMMED_MARKER)
+        compacted = 0
+        while True:
+            async with self.database.engine.begin() as conn:
+                result = await conn.execute(
+                    sql_text(
+                        """
+                        UPDATE steps SET
+                            "input" = CASE WHEN length("input") > :max_chars
+                                THEN left("input", :keep) || :marker
+                                ELSE "input" END,
+                            "output" = CASE WHEN length("output") > :max_chars
+                                THEN left("output", :keep) || :marker
+                                ELSE "output" END,
+                            "generation" = NULL
+                        WHERE ("id", "createdAt") IN (
+                            SELECT "id", "createdAt" FROM steps
+                            WHERE "createdAt" < now() - make_interval(days => :days)
+                            AND "type" <> ALL(:message_types)
+                            AND (
+                                length("input") > :max_chars
+                                OR length("output") > :max_chars
+                                OR length(CAST("generation" AS text)) > :max_chars
+                            )
+                            LIMIT :limit
+                        )
+                        """
+                    ),
+                    {
+                        "days": days,
+                        "max_chars": max_chars,
+                        "keep": keep,
+                        "marker": TRIMMED_MARKER,
+                        "message_types": MESSAGE_STEP_TYPES,
+                        "limit": self.batch_size,
+                    },
+                )
+            compacted += result.rowcount
+            if result.rowcount < self.batch_size:
+                break
+        logger.info("steps: compacted %d rows", compacted)
+
+
+async def run(args: argparse.Namespace, database: Database) -> None:
+    retention = Retention(database, batch_size=args.batch_size)
+    if args.command == "partition":
+        if args.steps:
+            await retention.partition_steps()
+        if args.embeddings:
+            await retention.partition_embeddings()
+    else:
+        await retention.run()
+
+    await database.engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--batch-size", type=int, default=5000)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("run", help="Create partitions, expire and compact steps")
+    partition = commands.add_parser(
+        "partition", help="Convert tables to partitioned tables"
+    )
+    partition.add_argument("--steps", action="store_true")
+    partition.add_argument("--embeddings", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    # Database bootstraps its tables with asyncio.run, so it is created before
+    # the retention loop starts
+    asyncio.run(run(args, Database()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+import chainlit as cl
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.pydantic_v1 import Field, PrivateAttr
+from langchain_core.retrievers import BaseRetriever
+from langchain_postgres import PGVector
+
+from embeddings import get_embeddings
+from metrics import track_stage
+from reranker import CrossEncoderReranker
+
+
+class UserCollectionRetriever(BaseRetriever):
+    """
+    Searches the PGVector collection of the user in the current Chainlit session.
+    A single instance is shared by every session in the process; the vector
+    store handle for each collection is created once and reused.
+
+    When `file_shortlist_size` is set, retrieval runs in two stages: the files
+    whose summary embedding is closest to the query are selected first, and
+    only their chunks are searched, by file id.
+
+    With a `reranker`, `rerank_candidates` chunks are fetched instead of
+    `search_kwargs["k"]` and the reranker decides which of them are returned.
+
+    With a quantised `vector_index_mode`, chunks are searched through the
+    matching index and rescored exactly, see `Database.search_chunks`.
+
+    The vector store and database connections are async, so sync retrieval
+    runs the search on the event loop passed to `bind_loop` and waits for it
+    from the calling thread.
+    """
+
+    connection: Any
+    database: Any
+    search_kwargs: Dict[str, Any] = Field(default_factory=lambda: {"k": 5})
+    file_shortlist_size: int = 0
+    reranker: Optional[CrossEncoderReranker] = None
+    rerank_candidates: int = 20
+    vector_index_mode: str = "full"
+    vector_index_dimensions: int = 0
+    vector_index_candidates: int = 100
+
+    _vector_stores: Dict[Tuple[str, str], PGVector] = PrivateAttr(default_factory=dict)
+    _loop: Optional[asyncio.AbstractEventLoop] = PrivateAttr(default=None)
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+
+    def vector_store(self, collection_name: str, embeddings_model: str) -> PGVector:
+        key = (collection_name, embeddings_model)
+        vector_store = self._vector_stores.get(key)
+        if vector_store is None:
+            vector_store = PGVector(
+                connection=self.connection,
+                embeddings=get_embeddings(embeddings_model),
+                collection_name=collection_name,
+            )
+            self._vector_stores[key] = vector_store
+        return vector_store
+
+    def _search_kwargs(self) -> Dict[str, Any]:
+        search_kwargs = dict(self.search_kwargs)
+        if self.reranker is not None:
+            search_kwargs["k"] = self.rerank_candidates
+        return search_kwargs
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        if self._loop is None or not self._loop.is_running():
+            raise RuntimeError("Sync retrieval needs the event loop from bind_loop")
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            raise RuntimeError(
+                "Sync retrieval would block the event loop, use ainvoke instead"
+            )
+
+        user_identifier = cl.user_session.get("user").identifier
+        documents = asyncio.run_coroutine_threadsafe(
+            self._asearch(query, user_identifier), self._loop
+        ).result()
+        if self.reranker is None:
+            return documents
+
+        with track_stage("rerank"):
+            return self.reranker.rerank(query, documents)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        documents = await self._asearch(
+            query, cl.user_session.get("user").identifier
+        )
+        if self.reranker is None:
+            return documents
+
+        with track_stage("rerank"):
+            return await self.reranker.arerank(query, documents)
+
+    async def _asearch(self, query: str, user_identifier: str) -> List[Document]:
+        # Collections keep the model they were embedded with until reindex.py
+        # moves them to a new one
+        embeddings_model = await self.database.fetch_collection_embeddings_model(
+            user_identifier
+        )
+        if embeddings_model is None:
+            return []
+
+        vector_store = self.vector_store(user_identifier, embeddings_model)
+        search_kwargs = self._search_kwargs()
+        if not self.file_shortlist_size and self.vector_index_mode == "full":
+            return await vector_store.asimilarity_search(query, **search_kwargs)
+
+        query_embedding = await vector_store.embeddings.aembed_query(query)
+
+        # The shortlist keeps files without a summary embedding, e.g. those
+        # uploaded before `migrate.py file-ids`; only a user without any files
+        # gets an empty shortlist, and then the whole collection is searched
+        file_ids = None
+        if self.file_shortlist_size:
+            with track_stage("file_shortlist"):
+                file_ids = await self.database.fetch_file_shortlist(
+                    user_identifier, query_embedding, self.file_shortlist_size
+                )
+
+        # Collections still on a model with fewer dimensions than the index,
+        # until reindex.py moves them, are searched exactly
+        if file_ids or (
+            self.vector_index_mode != "full"
+            and len(query_embedding) >= self.vector_index_dimensions
+        ):
+            results = await self.database.search_chunks(
+                user_identifier,
+                query_embedding,
+                k=search_kwargs["k"],
+                mode=self.vector_index_mode,
+                dimensions=self.vector_index_dimensions,
+                candidates=self.vector_index_candidates,
+                file_ids=file_ids,
+            )
+            return [document for document, _ in results]
+
+        return await vector_store.asimilarity_search_by_vector(
+            query_embedding, **search_kwargs
+        )
@@ -0,0 +1,143 @@
+import asyncio
+import struct
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+import httpx
+
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class ClamdError(Exception):
+    pass
+
+
+@dataclass
+class ScanResult:
+    infected: bool
+    signature: Optional[str] = None
+
+
+class ClamdScanner:
+    """
+    Async clamd client. Files are streamed with the INSTREAM command over
+    IDSESSION connections, which clamd keeps open between commands, so idle
+    connections are pooled and reused. At most `max_concurrency` scans run at
+    the same time.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        max_concurrency: int,
+        pool_size: int,
+        timeout: float,
+    ):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._idle: List[Connection] = []
+
+    async def scan(self, read_chunks: Callable[[], AsyncIterator[bytes]]) -> ScanResult:
+        """
+        Scans the bytes produced by `read_chunks()`. The factory is called again
+        if a pooled connection turns out to be closed and the scan is retried.
+        """
+        async with self._semaphore:
+            reply = await self._scan(read_chunks)
+
+        if reply.endswith("OK"):
+            return ScanResult(infected=False)
+        if reply.endswith("FOUND"):
+            return ScanResult(
+                infected=True, signature=reply.removesuffix("FOUND").strip()
+            )
+        raise ClamdError(f"Unexpected clamd reply: {reply}")
+
+    async def _scan(self, read_chunks: Callable[[], AsyncIterator[bytes]]) -> str:
+        while True:
+            connection, reused = await self._acquire()
+            try:
+                reply = await asyncio.wait_for(
+                    self._instream(connection, read_chunks()), self.timeout
+                )
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                _close(connection)
+                # clamd drops sessions that sat idle for longer than its IdleTimeout
+                if reused:
+                    continue
+                raise ClamdError(f"Unable to scan with clamd: {e!r}") from e
+            except BaseException:
+                # e.g. cancellation or an error raised by read_chunks, which
+                # leave the session mid-stream
+                _close(connection)
+                raise
+
+            self._release(connection)
+            return reply
+
+    async def close(self) -> None:
+        while self._idle:
+            _close(self._idle.pop())
+
+    async def _acquire(self) -> Tuple[Connection, bool]:
+        if self._idle:
+            return self._idle.pop(), True
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+        writer.write(b"zIDSESSION\0")
+        await writer.drain()
+        return (reader, writer), False
+
+    def _release(self, connection: Connection) -> None:
+        if len(self._idle) < self.pool_size:
+            self._idle.append(connection)
+        else:
+            _close(connection)
+
+    async def _instream(
+        self, connection: Connection, chunks: AsyncIterator[bytes]
+    ) -> str:
+        reader, writer = connection
+        writer.write(b"zINSTREAM\0")
+        async for chunk in chunks:
+            writer.write(struct.pack("!L", len(chunk)) + chunk)
+            await writer.drain()
+        writer.write(struct.pack("!L", 0))
+        await writer.drain()
+
+        # Replies in a session are prefixed with the command id, e.g. "1: stream: OK"
+        reply = (await reader.readuntil(b"\0"))[:-1].decode()
+        return reply.split(": ", 1)[-1]
+
+
+def _close(connection: Connection) -> None:
+    connection[1].close()
+
+
+async def scan_with_rest_api(url: str, filename: str, content: bytes) -> ScanResult:
+    """
+    Scans a file through the clamav-rest-api service.
+    """
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                url, files=[("FILES", (filename, content))], timeout=120.0
+            )
+    except httpx.HTTPError as e:
+        raise ClamdError(f"Unable to reach the ClamAV REST API: {e!r}") from e
+
+    if response.status_code != 200:
+        raise ClamdError(f"Unable to scan file: {response.text}")
+
+    response_json = response.json()
+    if response_json["success"]:
+        for data in response_json["data"]["result"]:
+            if data["is_infected"]:
+                return ScanResult(infected=True, signature=", ".join(data["viruses"]))
+    return ScanResult(infected=False)
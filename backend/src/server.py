@@ -1,5 +1,7 @@
+import asyncio
 import string
-from typing import Optional
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
 import uuid
 
 import chainlit as cl
@@ -12,16 +14,23 @@ from chainlit.server import app
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.routing import APIRoute
 import httpx
-from langchain.memory import ConversationBufferWindowMemory
 from langchain_core.runnables import RunnableConfig
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import ChatOpenAI
 from langchain.chains import create_citation_fuzzy_match_chain
-from langchain_postgres import PGVector
 
+from admission import AdmissionController, Overloaded
 from agent import create_agent
 from database import Database
+from embeddings import vector_index_dimensions
+from memory import BackgroundSummaryBufferMemory
+from metrics import UsageMetricsCallbackHandler, track_stage
+from metrics import router as metrics_router
+from reranker import CrossEncoderReranker
+from retrieval import UserCollectionRetriever
 from settings import settings
 from api import router
+from loop_watchdog import EventLoopWatchdog
+from invalidation import invalidation_bus
 
 
 # Middleware to handle CORS settings
@@ -34,6 +43,37 @@ app.add_middleware(
 )
 
 app.include_router(router)
+app.include_router(metrics_router)
+
+watchdog = EventLoopWatchdog(
+    interval=settings.event_loop_lag_interval,
+    threshold=settings.event_loop_stall_threshold,
+    debug=settings.event_loop_debug,
+)
+chainlit_lifespan = app.router.lifespan_context
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Wraps the Chainlit lifespan to run the event loop watchdog and the cache
+    invalidation listener alongside the server.
+    """
+    if settings.event_loop_watchdog_enabled:
+        watchdog.start()
+    if settings.cache_enabled:
+        invalidation_bus.start(database.engine)
+    retriever.bind_loop(asyncio.get_running_loop())
+    try:
+        async with chainlit_lifespan(app) as state:
+            yield state
+    finally:
+        await invalidation_bus.stop()
+        if settings.event_loop_watchdog_enabled:
+            watchdog.stop()
+
+
+app.router.lifespan_context = lifespan
 
 FILE_DELIMITER = "/"
 SUPPORTED_CONTENT_TYPES = [
@@ -46,6 +86,50 @@ SUPPORTED_CONTENT_TYPES = [
 
 database = Database()
 
+# The agent and retriever hold no per-session state, so they are built once per process
+reranker = (
+    CrossEncoderReranker(
+        model_name=settings.rerank_model,
+        score_threshold=settings.rerank_score_threshold,
+        token_budget=settings.rerank_token_budget,
+    )
+    if settings.rerank_enabled
+    else None
+)
+retriever = UserCollectionRetriever(
+    connection=database.engine,
+    database=database,
+    search_kwargs={"k": settings.retrieval_k},
+    file_shortlist_size=settings.retrieval_file_shortlist_size,
+    reranker=reranker,
+    rerank_candidates=settings.rerank_candidates,
+    vector_index_mode=settings.vector_index_mode,
+    vector_index_dimensions=(
+        vector_index_dimensions() if settings.vector_index_mode != "full" else 0
+    ),
+    vector_index_candidates=settings.vector_index_candidates,
+)
+agent = create_agent(
+    llm_name=settings.openai_chat_model,
+    retriever=retriever,
+    verbose=settings.agent_verbose,
+)
+usage_metrics = UsageMetricsCallbackHandler()
+citation_chain = create_citation_fuzzy_match_chain(
+    ChatOpenAI(temperature=0, model=settings.openai_chat_model)
+)
+chat_admission = AdmissionController(
+    "chat",
+    global_concurrency=settings.chat_max_concurrency,
+    user_concurrency=settings.chat_max_concurrency_per_user,
+    rate_per_minute=settings.chat_rate_per_minute,
+    burst=settings.chat_burst,
+    queue_timeout=settings.admission_queue_timeout,
+)
+memory_llm = ChatOpenAI(
+    temperature=0, model=settings.openai_chat_model, callbacks=[usage_metrics]
+)
+
 # We have to do this because of special characters in the OAuth /authorize step trips up AWS Cognito. So we are monkey-patching out this character.
 # FIXME: Remove this monkeypatch once chainlit fixes it
 chainlit.secret.chars = string.ascii_letters + string.digits
@@ -74,7 +158,7 @@ async def create_conversation() -> dict:
 @cl.on_chat_start
 async def on_chat_start() -> None:
     """
-    Handles the chat start event and initializes conversation or memory.
+    Handles the chat start event and initializes the conversation.
     """
     if settings.converge_api_enabled:
         try:
@@ -84,46 +168,62 @@ async def on_chat_start() -> None:
         except Exception as e:
             logger.error(f"Error creating conversation: {e}")
     else:
-        initialize_memory_and_agent()
+        logger.info("Chat has started!")
 
 
-def initialize_memory_and_agent() -> None:
+@cl.on_chat_resume
+async def on_chat_resume(thread: dict) -> None:
     """
-    Initializes memory and agent for the chat session.
+    Handles the chat resume event. Memory is rehydrated lazily on the next message.
     """
-    memory = ConversationBufferWindowMemory(
+    if settings.converge_api_enabled and not cl.user_session.get("conversation_id"):
+        await on_chat_start()
+    else:
+        logger.info("Chat has resumed!")
+
+
+def create_memory() -> BackgroundSummaryBufferMemory:
+    """
+    Creates an empty chat memory.
+    """
+    return BackgroundSummaryBufferMemory(
+        llm=memory_llm,
         memory_key="chat_history",
-        input_key="input",
+        input_key="question",
         output_key="output",
         return_messages=True,
-        k=settings.num_of_messages_in_memory,
+        max_token_limit=settings.memory_max_tokens,
+        max_turns=settings.num_of_messages_in_memory,
     )
 
-    vector_store = PGVector(
-        connection=database.engine,
-        embeddings=OpenAIEmbeddings(),
-        collection_name=cl.user_session.get("user").identifier,
-    )
 
-    retriever = vector_store.as_retriever(search_kwargs={"k": 5})
-    cl.user_session.set("retriever", retriever)
+async def load_memory() -> BackgroundSummaryBufferMemory:
+    """
+    Returns the memory of the chat session, rehydrating it from the database
+    when this worker has not served the session before.
+    """
+    memory = cl.user_session.get("memory")
+    if memory is not None:
+        return memory
 
-    agent = create_agent(
-        llm_name=settings.openai_chat_model,
-        retriever=retriever,
-        memory=memory,
-    )
+    memory = create_memory()
+    with track_stage("memory_load"):
+        state = await database.fetch_chat_session(
+            cl.user_session.get("user").identifier, cl.context.session.thread_id
+        )
+    if state:
+        memory.load_state(state)
 
-    cl.user_session.set("agent", agent)
-    logger.info("Chat has started!")
+    cl.user_session.set("memory", memory)
+    return memory
 
 
 async def extract_context(question: str) -> str:
     """
     Extracts context from the retriever based on the question provided.
     """
-    retriever = cl.user_session.get("retriever")
-    search_results = await retriever.aget_relevant_documents(question)
+    with track_stage("retrieval"):
+        search_results = await retriever.aget_relevant_documents(question)
 
     context = "\n\n".join(
         f"{result.page_content}\n(Source: {result.metadata.get('name', 'unknown')})"
@@ -133,48 +233,20 @@ async def extract_context(question: str) -> str:
     return context
 
 
-async def run_with_custom_prompt(question: str) -> str:
+async def build_turn_inputs(question: str) -> Dict[str, str]:
     """
-    Runs the provided question with a custom prompt and returns the result.
+    Returns the per-turn variables of the agent prompt: the question, the
+    retrieved context and the citations found in it. The static instructions
+    are part of the agent's system prompt.
     """
     context = await extract_context(question)
 
-    # Initialize the LLM and citation chain
-    llm = ChatOpenAI(temperature=0, model=settings.openai_chat_model)
-    chain = create_citation_fuzzy_match_chain(llm)
-
-    # Run the chain with the input
-    result = chain.run(question=question, context=context)
-
-    custom_result = (f"""{result}
-You are a productivity assistant with two capabilities:
+    with track_stage("citation_chain"):
+        citations = await citation_chain.arun(
+            question=question, context=context, callbacks=[usage_metrics]
+        )
 
-Capability 1) Searching documents/files and answering questions.
-- You can respond with answers only when a relevant question is asked,
-and only when you have access to the specific documents or files.
-- If the question is not relevant, or you do not have such access,
-you must not tell users the given format, you must not provide any answers,
-and you must only respond with your capabilities.
-- Else, make sure to be accurate and not too concise,
-use prose and bullets where appropriate,
-and format your response in the order of 3 sections with bold headers:
-1) Fact(s)
-2) Chunk(s) used to answer the question (include the page/section/FAQ headers if any)
-3) Source(s) - for this section, make sure to cite the file name
-
-Capability 2) Referencing speech writing guidelines to write speeches.
-- You must reference relevant speech writing documents/files.
-- Format your response in the order of 3 sections with bold headers:
-1) Speech - for this section, make sure to group similar points into paragraphs, and keep each paragraph as a numbered point
-2) Chunk(s) used to write the speech (include the page/section/FAQ headers if any)
-3) Source(s) - for this section, make sure to cite the file name
-
-You are to only use one capability at any one time.
-You are allowed to respond to follow up questions.
-
-{context}""")
-
-    return custom_result
+    return {"question": question, "citations": str(citations), "context": context}
 
 
 async def create_message(conversation_id: str, content: str) -> str:
@@ -205,10 +277,21 @@ async def main(message: cl.Message) -> None:
     """
     Handles incoming messages and processes them according to the chat settings.
     """
-    if settings.converge_api_enabled:
-        await handle_converge_message(message)
-    else:
-        await handle_standard_message(message)
+    user_identifier = cl.user_session.get("user").identifier
+    try:
+        async with chat_admission.admit(user_identifier):
+            with track_stage("chat_turn"):
+                if settings.converge_api_enabled:
+                    await handle_converge_message(message)
+                else:
+                    await handle_standard_message(message)
+    except Overloaded as e:
+        logger.warning(f"Rejected chat turn for {user_identifier}: {e}")
+        await cl.Message(
+            content="You are sending messages too quickly. Please try again in "
+            f"{e.retry_after_header['Retry-After']} seconds."
+        ).send()
+        return
 
     logger.info("Response sent to user!")
 
@@ -218,7 +301,8 @@ async def handle_converge_message(message: cl.Message) -> None:
     Handles messages when the converge API is enabled.
     """
     try:
-        result = await create_message(cl.user_session.get("conversation_id"), message.content)
+        with track_stage("converge_message"):
+            result = await create_message(cl.user_session.get("conversation_id"), message.content)
         await cl.Message(content=result).send()
     except Exception as e:
         logger.error(f"Error creating message: {e}")
@@ -232,20 +316,23 @@ async def handle_standard_message(message: cl.Message) -> None:
     cb = cl.AsyncLangchainCallbackHandler(
         stream_final_answer=True, force_stream_final_answer=True
     )
-    agent = cl.user_session.get("agent")
-    agent_config = RunnableConfig(callbacks=[cb])
+    agent_config = RunnableConfig(callbacks=[cb, usage_metrics])
 
-    result = await run_with_custom_prompt(message.content)
-
-    # Ensure result is a string
-    if not isinstance(result, str):
-        result = str(result)
+    memory = await load_memory()
+    inputs = await build_turn_inputs(message.content)
+    inputs.update(memory.load_memory_variables(inputs))
 
     # Send the result back to the user
-    await agent.ainvoke(
-        input={"input": result},
-        config=agent_config,
-    )
+    with track_stage("agent"):
+        outputs = await agent.ainvoke(input=inputs, config=agent_config)
+
+    await memory.asave_context(inputs, outputs)
+    with track_stage("memory_save"):
+        await database.save_chat_session(
+            cl.user_session.get("user").identifier,
+            cl.context.session.thread_id,
+            memory.to_state(),
+        )
 
 
 def create_user(user_email: str) -> dict:
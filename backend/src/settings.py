@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic import Field, HttpUrl, SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -27,17 +27,121 @@ class Settings(BaseSettings):
     azure_doc_api_model: str = Field()
     azure_doc_api_version: str = Field()
 
+    # Local text-layer extraction, Azure is only used for pages without text
+    local_extraction_enabled: Optional[bool] = Field(default=True)
+    local_extraction_workers: Optional[int] = Field(default=2)
+    local_extraction_min_chars_per_page: Optional[int] = Field(default=20)
+
     # OpenAI API Configuration
     openai_api_base: HttpUrl = Field()
     openai_api_key: SecretStr = Field()
     openai_chat_model: str = Field()
+    openai_input_cost_per_million: Optional[float] = Field(default=0.0)
+    openai_output_cost_per_million: Optional[float] = Field(default=0.0)
+    # Prompt tokens served from the provider's cache; defaults to the input cost
+    openai_cached_input_cost_per_million: Optional[float] = Field(default=None)
+
+    # Embeddings, used for both ingestion and retrieval
+    embeddings_provider: Literal["openai", "local"] = Field(default="openai")
+    openai_embeddings_model: Optional[str] = Field(default="text-embedding-ada-002")
+    # Shortened output, only supported by text-embedding-3 and Matryoshka models
+    embeddings_dimensions: Optional[int] = Field(default=None)
+    # Model of collections created before collections recorded their model
+    legacy_embeddings_model: Optional[str] = Field(
+        default="openai:text-embedding-ada-002"
+    )
+    local_embeddings_model: Optional[str] = Field(
+        default="sentence-transformers/all-MiniLM-L6-v2"
+    )
+    local_embeddings_backend: Literal["torch", "onnx", "openvino"] = Field(
+        default="onnx"
+    )
+    local_embeddings_batch_size: Optional[int] = Field(default=32)
+    local_embeddings_workers: Optional[int] = Field(default=2)
 
     # ClamAV file scanning
     clam_av_scan: Optional[bool] = Field(default=False)
     clam_av_scan_url: Optional[HttpUrl] = Field(default=None)
+    clamd_host: Optional[str] = Field(default=None)
+    clamd_port: Optional[int] = Field(default=3310)
+    clamd_max_concurrency: Optional[int] = Field(default=4)
+    clamd_pool_size: Optional[int] = Field(default=4)
+    clamd_timeout: Optional[float] = Field(default=60.0)
+
+    # Admission control, per worker: concurrency limits for the worker and for
+    # each user, and a per-user token bucket. 0 disables a limit
+    admission_queue_timeout: Optional[float] = Field(default=10.0)
+    chat_max_concurrency: Optional[int] = Field(default=32)
+    chat_max_concurrency_per_user: Optional[int] = Field(default=1)
+    chat_rate_per_minute: Optional[float] = Field(default=20)
+    chat_burst: Optional[int] = Field(default=5)
+    upload_max_concurrency: Optional[int] = Field(default=4)
+    upload_max_concurrency_per_user: Optional[int] = Field(default=2)
+    upload_rate_per_minute: Optional[float] = Field(default=30)
+    upload_burst: Optional[int] = Field(default=20)
+    files_max_concurrency: Optional[int] = Field(default=16)
+    files_max_concurrency_per_user: Optional[int] = Field(default=2)
+    files_rate_per_minute: Optional[float] = Field(default=120)
+    files_burst: Optional[int] = Field(default=20)
+
+    # Batch uploads (POST /api/files/batch)
+    batch_upload_max_files: Optional[int] = Field(default=200)
+    # Total bytes staged for a batch: uploaded files and archives, and the files
+    # extracted from the archives
+    batch_upload_max_size: Optional[int] = Field(default=500 * 1024 * 1024)
+    batch_upload_load_concurrency: Optional[int] = Field(default=4)
+    batch_upload_embed_concurrency: Optional[int] = Field(default=2)
+    batch_upload_write_group_size: Optional[int] = Field(default=16)
 
     # Chat settings
     num_of_messages_in_memory: Optional[int] = Field(default=5)
+    retrieval_k: Optional[int] = Field(default=5)
+    # Number of files shortlisted before searching chunks, 0 searches every file
+    retrieval_file_shortlist_size: Optional[int] = Field(default=20)
+    # Chunk search through a half-precision or binary HNSW index over the first
+    # vector_index_dimensions components (default all of them), rescored with
+    # the full vectors. The index is built by migrate.py
+    vector_index_mode: Literal["full", "halfvec", "binary"] = Field(default="full")
+    vector_index_dimensions: Optional[int] = Field(default=None)
+    vector_index_candidates: Optional[int] = Field(default=100)
+    # Cross-encoder reranking of over-fetched chunks, see reranker.py
+    rerank_enabled: Optional[bool] = Field(default=False)
+    rerank_model: Optional[str] = Field(default="cross-encoder/ms-marco-MiniLM-L-6-v2")
+    rerank_candidates: Optional[int] = Field(default=20)
+    rerank_score_threshold: Optional[float] = Field(default=0.1)
+    rerank_token_budget: Optional[int] = Field(default=3000)
+    memory_max_tokens: Optional[int] = Field(default=1500)
+    agent_verbose: Optional[bool] = Field(default=False)
+
+    # Chat history: steps loaded when a thread is opened or resumed, latest first
+    thread_history_max_steps: Optional[int] = Field(default=500)
+
+    # Chat history retention, see retention.py. Step partitions cover one
+    # interval (day, week or month) each; retention and compaction ages are in
+    # days, 0 keeps everything
+    steps_partition_interval: Optional[Literal["day", "week", "month"]] = Field(
+        default="month"
+    )
+    steps_partitions_ahead: Optional[int] = Field(default=3)
+    steps_retention_days: Optional[int] = Field(default=0)
+    steps_compact_after_days: Optional[int] = Field(default=0)
+    steps_compact_max_chars: Optional[int] = Field(default=2000)
+    embeddings_partitions: Optional[int] = Field(default=16)
+
+    # Per-user caches of file lists and collection models (TTL in seconds), kept
+    # coherent across workers with Postgres LISTEN/NOTIFY
+    cache_enabled: Optional[bool] = Field(default=True)
+    cache_ttl: Optional[float] = Field(default=300)
+
+    # Bearer token Prometheus presents to scrape /metrics, which is disabled
+    # without one
+    metrics_token: Optional[SecretStr] = Field(default=None)
+
+    # Event loop watchdog (intervals in seconds)
+    event_loop_watchdog_enabled: Optional[bool] = Field(default=True)
+    event_loop_lag_interval: Optional[float] = Field(default=0.1)
+    event_loop_stall_threshold: Optional[float] = Field(default=0.25)
+    event_loop_debug: Optional[bool] = Field(default=False)
 
     # Converge API
     converge_api_url: Optional[HttpUrl] = Field(default=None)